@@ -0,0 +1,65 @@
+"""Benchmark: timestamp parsing, pd.to_datetime() format inference vs parse_timestamps().
+
+Resamples the raw Date and Updated On strings of dataset.csv up to the
+requested size, then times the dashboard's original inference-based
+parse against the explicit-format parser, with and without its cache of
+unique strings.
+
+    python bench_dates.py ../exercise_files/dataset.csv --rows 5000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from crime_data import DATE_COLUMNS, DATE_FORMATS, parse_timestamps
+
+
+def inferred(series):
+    # The dashboard's original Date parsing
+    return pd.to_datetime(series, errors='coerce')
+
+
+def explicit_uncached(series):
+    # Known format, but every row parsed
+    return pd.to_datetime(series, format=DATE_FORMATS[0], errors='coerce')
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='dataset.csv')
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sample = pd.read_csv(args.csv, usecols=DATE_COLUMNS, dtype=str)
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, len(sample), args.rows)
+    print(f"{args.rows:,} rows resampled from {len(sample):,} in {args.csv}")
+
+    for col in DATE_COLUMNS:
+        series = sample[col].take(rows).reset_index(drop=True).astype(object)
+        print(f"\n{col} ({series.nunique():,} unique strings):")
+        inferred_time, expected = best_of(args.repeat, inferred, series)
+        explicit_time, _ = best_of(args.repeat, explicit_uncached, series)
+        cached_time, parsed = best_of(args.repeat, parse_timestamps, series)
+        assert (parsed.astype(expected.dtype) == expected).where(expected.notna(), parsed.isna()).all()
+        print(f"  pd.to_datetime(), inferred format:     {inferred_time * 1000:9.1f} ms")
+        print(f"  pd.to_datetime(), explicit format:     {explicit_time * 1000:9.1f} ms  "
+              f"({inferred_time / explicit_time:.1f}x)")
+        print(f"  parse_timestamps(), unique strings:    {cached_time * 1000:9.1f} ms  "
+              f"({inferred_time / cached_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
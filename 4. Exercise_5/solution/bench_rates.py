@@ -0,0 +1,68 @@
+"""Benchmark: arrest rate by crime type, groupby().apply(lambda) vs flag_rates().
+
+Resamples the rows of dataset.csv up to the requested size, then times the
+dashboard's original per-group lambda against the vectorized sum/count engine.
+
+    python bench_rates.py ../exercise_files/dataset.csv --rows 5000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from crime_aggregates import flag_rates
+from crime_data import read_crime_csv
+
+
+def lambda_rates(df, by='Primary Type'):
+    # The dashboard's original "Arrest Rate by Crime Type" computation
+    return df.groupby(by, observed=True)['Arrest'].apply(
+        lambda x: (x == True).sum() / len(x) * 100 if len(x) > 0 else 0
+    )
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='dataset.csv')
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sample = read_crime_csv(args.csv)
+    columns = ['Primary Type', 'Arrest', 'Domestic', 'District', 'Ward', 'Community Area']
+    rng = np.random.default_rng(0)
+    df = sample[columns].take(rng.integers(0, len(sample), args.rows)).reset_index(drop=True)
+    print(f"{len(df):,} rows resampled from {len(sample):,} in {args.csv}")
+
+    # Categorical Primary Type is the dashboard's layout; object strings were the original one
+    layouts = [('categorical', df), ('object', df.astype({'Primary Type': object}))]
+    for layout, frame in layouts:
+        lambda_time, expected = best_of(args.repeat, lambda_rates, frame)
+        arrest_time, rates = best_of(args.repeat, flag_rates, frame, 'Primary Type', ['Arrest'])
+        both_time, _ = best_of(args.repeat, flag_rates, frame, 'Primary Type')
+        assert np.allclose(expected.sort_index().to_numpy(), rates['Arrest'].sort_index().to_numpy())
+        print(f"\nPrimary Type as {layout}:")
+        print(f"  groupby().apply(lambda), arrest rate:      {lambda_time * 1000:9.1f} ms")
+        print(f"  flag_rates(), arrest rate:                 {arrest_time * 1000:9.1f} ms  "
+              f"({lambda_time / arrest_time:.1f}x)")
+        print(f"  flag_rates(), arrest + domestic rate:      {both_time * 1000:9.1f} ms")
+
+    print("\nBy area (categorical layout):")
+    for area in ['District', 'Ward', 'Community Area']:
+        lambda_time, _ = best_of(args.repeat, lambda_rates, df, area)
+        area_time, _ = best_of(args.repeat, flag_rates, df, area, ['Arrest'])
+        print(f"  {area + ':':16} lambda {lambda_time * 1000:7.1f} ms, flag_rates() {area_time * 1000:7.1f} ms "
+              f"({lambda_time / area_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark: memory per row of the crime frame in the full and the compact layout.
+
+Loads the dataset (parsed, without a snapshot) once per layout, each in a
+fresh process, and reports the frame's bytes per row for every column and
+in total, and the growth of the process RSS per row once the memory the
+parse freed is handed back to the OS. 'objects' is the full layout with
+its text as Python str objects, as pandas before 3.0 reads it.
+
+RSS per row only means something for a large CSV: on dataset.csv's 1,000
+rows it is all imports and allocator overhead. Generate one with crime_synth:
+
+    python crime_synth.py ../exercise_files/dataset.csv /tmp/crimes_1M.csv --rows 1M
+    python bench_schema.py /tmp/crimes_1M.csv
+"""
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import subprocess
+import sys
+
+import pandas as pd
+import pyarrow as pa
+
+from crime_data import load_crime_data
+from crime_profiling import format_bytes, process_memory
+
+LAYOUTS = ['objects', 'full', 'compact']
+
+
+def release_free_memory():
+    """Hand memory the parse freed back to the OS, so RSS is what the frame holds."""
+    gc.collect()
+    pa.default_memory_pool().release_unused()
+    libc = ctypes.util.find_library('c')
+    if libc and hasattr(ctypes.CDLL(libc), 'malloc_trim'):  # glibc only
+        ctypes.CDLL(libc).malloc_trim(0)
+
+
+def measure(path, layout):
+    """Bytes per row of one layout, loaded in this process."""
+    gc.collect()
+    baseline, _ = process_memory()
+    df = load_crime_data(path, snapshot=False, compact=layout == 'compact')
+    if layout == 'objects':
+        text = [col for col in df.columns if pd.api.types.is_string_dtype(df[col]) and df[col].dtype != object]
+        df = df.astype({col: object for col in text})
+    release_free_memory()
+    rss, peak = process_memory()
+    usage = df.memory_usage(index=False, deep=True) / len(df)
+    return {'rows': len(df), 'columns': usage.round(2).to_dict(), 'dtypes': df.dtypes.astype(str).to_dict(),
+            'frame': usage.sum(), 'rss': (rss - baseline) / len(df), 'peak': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='dataset.csv')
+    parser.add_argument('--layouts', nargs='+', default=LAYOUTS, choices=LAYOUTS)
+    parser.add_argument('--layout', help=argparse.SUPPRESS)  # One layout, in a child process
+    args = parser.parse_args()
+
+    if args.layout:
+        print(json.dumps(measure(args.csv, args.layout)))
+        return
+
+    results = {}
+    for layout in args.layouts:
+        # A fresh process per layout, so no allocation of one is counted for the other
+        child = subprocess.run([sys.executable, __file__, args.csv, '--layout', layout],
+                               capture_output=True, text=True, check=True)
+        results[layout] = json.loads(child.stdout.strip().splitlines()[-1])
+    rows = next(iter(results.values()))['rows']
+    table = pd.DataFrame({layout: result['columns'] for layout, result in results.items()})
+    table.insert(0, 'compact dtype', pd.Series(results.get('compact', {}).get('dtypes', {})))
+    print(f"{rows:,} rows, bytes per row:")
+    print(table.fillna('-').to_string())
+    print()
+    for layout, result in results.items():
+        print(f"  {layout:8} frame {result['frame']:7.1f} B/row, RSS +{result['rss']:7.1f} B/row "
+              f"(+{format_bytes(result['rss'] * rows)}), peak {format_bytes(result['peak'])}")
+    if 'compact' in results:
+        for layout in [layout for layout in results if layout != 'compact']:
+            print(f"  compact vs {layout}: {results[layout]['frame'] / results['compact']['frame']:.1f}x less frame memory, "
+                  f"{results[layout]['rss'] / results['compact']['rss']:.1f}x less RSS")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Load test: N concurrent dashboard sessions, driven headless through Streamlit's AppTest.
+
+Each simulated session opens the dashboard and then reruns it --reruns
+times, each time after a random click: a sidebar filter, the viz type,
+renderer, granularity, map mode, zoom or preview sort. Sessions run in
+threads of one process, so they share the process-wide dataset, indexes
+and caches as real sessions of one server do.
+
+For each dataset size, a synthetic CSV with the schema and distributions
+of dataset.csv is generated (crime_synth) and loaded in a fresh process.
+Reported: reruns per second, rerun latency percentiles, memory per
+session and the dashboard's own per-stage p95s (crime_profiling).
+AppTest is made for one app at a time: concurrent runs now and then come
+back empty, and are counted as dropped rather than timed.
+
+    python bench_sessions.py ../exercise_files/dataset.csv --sizes 10k 1M 10M --sessions 8
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from crime_profiling import format_bytes, process_memory
+from crime_synth import CrimeModel, parse_rows, write_synthetic
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit-app.py')
+
+
+def by_label(widgets, label):
+    return next((widget for widget in widgets if widget.label == label), None)
+
+
+def random_subset(rng, options, most=3):
+    return list(rng.choice(options, rng.integers(0, most + 1), replace=False)) if len(options) else []
+
+
+def random_click(at, rng):
+    """Change one widget of the dashboard at random, like a visitor would."""
+    action = rng.integers(8)
+    if action < 3:
+        widget = by_label(at.multiselect, ["Select Year(s)", "Select Crime Type(s)",
+                                           "Select Location Description(s)"][action])
+        widget.set_value(random_subset(rng, widget.options))
+    elif action == 3:
+        widget = by_label(at.selectbox, "Arrest Made")
+        widget.set_value(rng.choice(widget.options))
+    elif action == 4:
+        widget = by_label(at.selectbox, "Select Visualization Type")
+        widget.set_value(rng.choice(widget.options))
+    elif action == 5:
+        # A widget inside the current tabs: renderer, granularity, area column or sort order
+        widgets = [by_label(at.radio, "Renderer"), by_label(at.selectbox, "Granularity"),
+                   by_label(at.selectbox, "Area"), by_label(at.selectbox, "Sort by")]
+        widget = rng.choice([widget for widget in widgets if widget is not None])
+        widget.set_value(rng.choice(widget.options))
+    elif action == 6:
+        widget = by_label(at.radio, "Map mode")
+        widget.set_value(rng.choice(widget.options))
+    else:
+        widget = by_label(at.slider, "Zoom level (sets the grid resolution)")
+        if widget is not None:
+            widget.set_value(int(rng.integers(8, 17)))
+
+
+def run_session(session, reruns, seed, timeout):
+    """Open the dashboard and click around; (latencies of the runs in seconds, failed runs, dropped runs)."""
+    from streamlit.testing.v1 import AppTest
+    rng = np.random.default_rng(seed + session)
+    latencies, failures, dropped = [], 0, 0
+    at = None
+    for _ in range(reruns + 1):
+        if at is None:
+            at = AppTest.from_file(APP, default_timeout=timeout)
+        else:
+            random_click(at, rng)
+        start = time.perf_counter()
+        at.run()
+        elapsed = time.perf_counter() - start
+        if at.exception:
+            failures += 1
+            print(f"session {session}: {at.exception[0].message}", file=sys.stderr)
+            at = None  # Start the session over
+        elif not at.title:
+            # AppTest swaps a process-wide mock runtime in and out around every run, so
+            # another session finishing can cut this run short with an empty page
+            dropped += 1
+            at = None
+        else:
+            latencies.append(elapsed)
+    return latencies, failures, dropped
+
+
+class MemorySampler:
+    """Highest current RSS of this process while running, sampled every `interval` seconds.
+
+    ru_maxrss is the peak over the whole process life, which includes the
+    dataset's load, so it cannot tell what the sessions themselves add.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+
+    def _sample(self):
+        while True:
+            current, _ = process_memory()
+            if current is not None:
+                self.peak = max(self.peak or 0, current)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def load_test(path, sessions, reruns, seed, timeout):
+    """Run the sessions against the dataset at `path` in this process; a dict of results."""
+    from streamlit.testing.v1 import AppTest
+    warnings.filterwarnings('ignore')
+    os.chdir(os.path.dirname(os.path.abspath(path)))
+    os.environ['CRIME_DATA_PATH'] = os.path.basename(path)
+    # Imported once the dataset is configured: crime_resources reads CRIME_DATA_PATH on import
+    from crime_resources import DATA_ENGINE, current_data, load_database, load_stage_timings
+
+    # Warm up: the first session loads the dataset and builds the indexes
+    start = time.perf_counter()
+    AppTest.from_file(APP, default_timeout=timeout).run()
+    warmup = time.perf_counter() - start
+    rows = load_database().n_rows if DATA_ENGINE == 'sql' else len(current_data().df)
+    baseline, _ = process_memory()
+    load_stage_timings().reset()  # Only time the load test itself
+
+    start = time.perf_counter()
+    with MemorySampler() as memory, ThreadPoolExecutor(max_workers=sessions) as pool:
+        results = list(pool.map(lambda session: run_session(session, reruns, seed, timeout), range(sessions)))
+    elapsed = time.perf_counter() - start
+    latencies = np.concatenate([latency for latency, _, _ in results])
+    stages = load_stage_timings().summary()
+    return {
+        'rows': rows,
+        'sessions': sessions,
+        'runs': len(latencies),
+        'failures': sum(failures for _, failures, _ in results),
+        'dropped': sum(dropped for _, _, dropped in results),
+        'warmup_s': warmup,
+        'runs_per_s': len(latencies) / elapsed,
+        'p50_ms': np.percentile(latencies, 50) * 1000,
+        'p95_ms': np.percentile(latencies, 95) * 1000,
+        'p99_ms': np.percentile(latencies, 99) * 1000,
+        'baseline_rss': baseline,
+        # None where the current RSS cannot be read (no /proc)
+        'per_session_bytes': (memory.peak - baseline) / sessions if memory.peak and baseline else None,
+        'stage_p95_ms': (stages['p95'] * 1000).round(1).to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='dataset.csv', help='schema and value source for the synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=['10k', '1M', '10M'], help='rows per dataset (k/M suffixes)')
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--reruns', type=int, default=20, help='clicks per session')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'crime-bench'),
+                        help='where the synthetic datasets (and their snapshots) are kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds a single rerun may take')
+    parser.add_argument('--run', metavar='CSV', help=argparse.SUPPRESS)  # One size, in a child process
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(load_test(args.run, args.sessions, args.reruns, args.seed, args.timeout)))
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    model = None
+    for size in args.sizes:
+        rows = parse_rows(size)
+        path = os.path.join(args.data_dir, f"crimes_{size}.csv")
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            model = model or CrimeModel.from_csv(args.csv)
+            write_synthetic(model, rows, path, args.seed)
+            print(f"Generated {rows:,} rows in {time.perf_counter() - start:.1f} s: {path}", flush=True)
+        # A fresh process per size, so no dataset, cache or memory carries over
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', path,
+                                '--sessions', str(args.sessions), '--reruns', str(args.reruns),
+                                '--seed', str(args.seed), '--timeout', str(args.timeout)],
+                               capture_output=True, text=True, env=os.environ)
+        if child.returncode != 0:
+            print(f"{size}: load test failed\n{child.stderr[-2000:]}")
+            continue
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        print(f"\n{result['rows']:,} rows, {result['sessions']} sessions x {args.reruns} clicks "
+              f"(first load {result['warmup_s']:.1f} s):")
+        print(f"  throughput:  {result['runs_per_s']:.1f} reruns/s ({result['runs']} runs, "
+              f"{result['failures']} failed, {result['dropped']} dropped by AppTest)")
+        print(f"  latency:     p50 {result['p50_ms']:.0f} ms, p95 {result['p95_ms']:.0f} ms, "
+              f"p99 {result['p99_ms']:.0f} ms")
+        if result['per_session_bytes'] is not None:
+            print(f"  memory:      {format_bytes(result['baseline_rss'])} after the first load, "
+                  f"+{format_bytes(result['per_session_bytes'])} per session (peak RSS during the test)")
+        print("  stage p95:   " + ", ".join(f"{stage} {ms} ms" for stage, ms in result['stage_p95_ms'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Benchmark: cold load of a directory of CSV shards with 1..N worker processes.
+
+Times read_shards() (no snapshot) for each worker count, prints the
+speedup over one worker, and the per-shard parse timings of the last run.
+Pass --split to first cut a single CSV into yearly shards.
+
+    python bench_shards.py shards/ --split ../exercise_files/dataset.csv --workers 1 2 4 8
+"""
+import argparse
+import os
+
+import pandas as pd
+
+from crime_data import read_shards
+
+
+def split_by_year(csv, folder):
+    os.makedirs(folder, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(csv))[0]
+    for year, shard in pd.read_csv(csv, dtype=str).groupby('Year'):
+        shard.to_csv(os.path.join(folder, f"{stem}_{year}.csv"), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folder')
+    parser.add_argument('--split', metavar='CSV', help='write yearly shards of CSV into folder first')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    if args.split:
+        split_by_year(args.split, args.folder)
+    print(f"{os.cpu_count()} cores")
+    baseline = None
+    for workers in args.workers:
+        df = read_shards(args.folder, workers=workers)
+        seconds = df.attrs['load_seconds']
+        baseline = baseline or seconds
+        print(f"  {workers:2d} workers: {len(df):,} rows in {seconds:7.2f} s  ({baseline / seconds:.1f}x)")
+    print("\nPer shard (last run):")
+    for shard in df.attrs['shards']:
+        print(f"  {shard['shard']:30} {shard['rows']:10,} rows {shard['seconds']:7.2f} s")
+
+
+if __name__ == '__main__':
+    main()
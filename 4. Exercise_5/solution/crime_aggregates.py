@@ -0,0 +1,733 @@
+"""Cached aggregates for the Chicago crime dashboard."""
+import copy
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from crime_index import contains
+
+# Memory budget of the shared aggregate cache, configurable per deployment
+DEFAULT_CACHE_MB = float(os.environ.get('CRIME_AGGREGATE_CACHE_MB', 64))
+
+
+def python_scalar(value):
+    """The plain Python value of a numpy scalar (for hashable keys and SQL parameters)."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def filter_key(filters):
+    """Normalized, hashable form of a {column: selected values} filter dict.
+
+    Empty selections are dropped and values are sorted, so the same filter
+    state always maps to the same key whatever order it was clicked in.
+    """
+    return tuple(sorted(
+        (col, tuple(sorted(python_scalar(v) for v in values)))
+        for col, values in filters.items() if len(values)
+    ))
+
+
+def estimate_size(value):
+    """Approximate size in bytes of a cached aggregate."""
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if callable(getattr(value, 'nbytes', None)):
+        return value.nbytes()
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class AggregateCache:
+    """Thread-safe LRU cache of aggregates, bounded by an approximate byte budget."""
+
+    def __init__(self, max_mb=DEFAULT_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        value = compute()
+        size = estimate_size(value)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self.nbytes += size
+                # Evict least recently used entries until back under budget
+                while self.nbytes > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# Flag columns that rates are computed for, and the area columns to slice them by
+RATE_FLAGS = ['Arrest', 'Domestic']
+AREA_COLUMNS = ['District', 'Ward', 'Community Area']
+
+
+def signed_pieces(df):
+    """`df` as (frame, sign) pieces: a frame is one piece; pieces (see SegmentedFrame.pieces) pass through."""
+    return df if isinstance(df, list) else [(df, 1)]
+
+
+def add_pieces(parts):
+    """Sum of per-piece results (Series or DataFrames), aligned on their index."""
+    total = parts[0]
+    for part in parts[1:]:
+        total = total.add(part, fill_value=0)
+    return total
+
+
+def flag_rates(df, by, flags=RATE_FLAGS):
+    """Incidents and percentage of rows with each flag set, per value of `by`.
+
+    Uses one groupby().agg(['sum', 'count']) over all flags, so no Python
+    function runs per group. `df` may also be signed pieces (see signed_pieces).
+    """
+    pieces = signed_pieces(df)
+    flags = [flag for flag in flags if flag in pieces[0][0].columns]
+    totals, sizes = [], []
+    for frame, sign in pieces:
+        # One grouper for all flags, so the keys are only factorized once
+        grouped = frame.groupby(by, observed=True)
+        totals.append(grouped[flags].agg(['sum', 'count']) * sign)
+        sizes.append(grouped.size() * sign)
+    totals, sizes = add_pieces(totals), add_pieces(sizes)
+    if len(pieces) > 1:
+        # Values whose every row was replaced away
+        totals, sizes = totals[sizes > 0], sizes[sizes > 0].astype(np.int64)
+    rates = totals.xs('sum', axis=1, level=1) / totals.xs('count', axis=1, level=1) * 100
+    rates.insert(0, 'Incidents', sizes)
+    return rates
+
+
+# Upper bound on grid cells sent to the browser by the map's density mode
+MAP_MAX_CELLS = 3000
+
+
+def grid_cell_size(zoom):
+    """Grid cell edge in degrees at a web-map zoom level (8 cells across a 256 px tile)."""
+    return 360 / 2 ** zoom / 8
+
+
+def spatial_grid(df, zoom, max_cells=MAP_MAX_CELLS):
+    """Incidents (and arrests) per square Latitude/Longitude grid cell.
+
+    Every row with coordinates is counted. If the grid for `zoom` has more
+    than `max_cells` occupied cells, the cell size is doubled until it fits.
+    Returns one row per cell with its center coordinates and the cell size.
+    `df` may also be signed pieces (see signed_pieces).
+    """
+    size = grid_cell_size(zoom)
+    pieces = signed_pieces(df)
+    cells = add_pieces([_grid_sums(frame, size) * sign for frame, sign in pieces])
+    if len(pieces) > 1:
+        cells = cells[cells['Incidents'] > 0].astype(np.int64)
+    return merge_grid(cells, size, max_cells)
+
+
+def _grid_sums(df, size):
+    """Incidents (and arrests) per (row, col) cell of `size` degrees."""
+    lat = df['Latitude'].to_numpy(dtype=float, na_value=np.nan)
+    lon = df['Longitude'].to_numpy(dtype=float, na_value=np.nan)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    points = pd.DataFrame({
+        'row': np.floor(lat[valid] / size).astype(np.int64),
+        'col': np.floor(lon[valid] / size).astype(np.int64),
+    })
+    if 'Arrest' in df.columns:
+        points['Arrests'] = df['Arrest'].fillna(False).to_numpy(dtype=bool)[valid]
+    points['Incidents'] = 1
+    return points.groupby(['row', 'col'], sort=False).sum()
+
+
+def merge_grid(cells, size, max_cells=MAP_MAX_CELLS):
+    """Map cells from per-(row, col) sums on a grid of `size` degrees, coarsened to fit `max_cells`."""
+    # floor(floor(x / s) / 2) == floor(x / 2s), so cells can be merged without the points
+    while len(cells) > max_cells:
+        size *= 2
+        cells = cells.groupby([cells.index.get_level_values('row') // 2,
+                               cells.index.get_level_values('col') // 2], sort=False).sum()
+        cells.index.names = ['row', 'col']
+    cells = cells.reset_index()
+    cells['Latitude'] = (cells.pop('row') + 0.5) * size
+    cells['Longitude'] = (cells.pop('col') + 0.5) * size
+    cells['Cell Size'] = size
+    return cells
+
+
+# Dimensions of the pre-aggregated cube, all low-cardinality filter/chart columns
+CUBE_DIMENSIONS = ['Year', 'Primary Type', 'Location Description', 'Arrest', 'Domestic']
+
+
+class CrimeCube:
+    """Incident counts and arrest sums over every combination of CUBE_DIMENSIONS.
+
+    Built with one groupby when the data loads; charts and metrics roll the
+    (small) cube up for the current filter instead of scanning the rows.
+    """
+
+    def __init__(self, df, dimensions=CUBE_DIMENSIONS):
+        self.dimensions = [col for col in dimensions if col in df.columns]
+        self._set_cells(df.groupby(self.dimensions, observed=True, dropna=False).size())
+
+    def _set_cells(self, cells):
+        self.cells = cells.rename('count').reset_index()
+        if 'Arrest' in self.dimensions:
+            self.cells['arrests'] = self.cells['count'].where(self.cells['Arrest'].fillna(False).astype(bool), 0)
+
+    def nbytes(self):
+        return int(self.cells.memory_usage(index=False).sum())
+
+    def patch(self, df, rows, before):
+        """Copy of the cube for `df` (a SegmentedFrame), whose rows `rows` changed; `before` holds their replaced versions.
+
+        The changed rows are counted into cells of their own (the replaced
+        versions negatively) and summed with the existing cells: the work is
+        proportional to the cells and the changed rows, not to all rows.
+        """
+        patched = copy.copy(self)
+        dtypes = {col: df.dtypes[col] for col in self.dimensions}
+        parts = [
+            self.cells[self.dimensions + ['count']].astype(dtypes),
+            df.take(rows).groupby(self.dimensions, observed=True, dropna=False).size().rename('count').reset_index(),
+            before.groupby(self.dimensions, observed=True, dropna=False).size().rename('count').reset_index(),
+        ]
+        parts[2]['count'] *= -1
+        cells = pd.concat([part.astype(dtypes) for part in parts], ignore_index=True)
+        cells = cells.groupby(self.dimensions, observed=True, dropna=False)['count'].sum()
+        patched._set_cells(cells[cells > 0])
+        return patched
+
+    def select(self, filters):
+        """Cube cells matching `filters` ({column: selected values})."""
+        mask = np.ones(len(self.cells), dtype=bool)
+        for col, selected in filters.items():
+            if col in self.dimensions and len(selected):
+                mask &= self.cells[col].isin(list(selected)).to_numpy(dtype=bool)
+        return self.cells[mask]
+
+    def rollup(self, filters, by):
+        """count (and arrests) per value of `by` for the filtered cells."""
+        measures = ['count', 'arrests'] if 'arrests' in self.cells.columns else ['count']
+        return self.select(filters).groupby(by, observed=True)[measures].sum()
+
+    def counts(self, filters, by):
+        return self.rollup(filters, by)['count']
+
+    def arrest_rates(self, filters, by):
+        """Arrest rate (%) per value of `by`."""
+        totals = self.rollup(filters, by)
+        return totals['arrests'] / totals['count'] * 100
+
+    def metrics(self, filters):
+        """Values for the dashboard's metric cards; None where a column is missing."""
+        cells = self.select(filters)
+        metrics = {'total': int(cells['count'].sum()), 'arrests': None, 'crime_types': None,
+                   'year_min': None, 'year_max': None}
+        if 'arrests' in cells.columns:
+            metrics['arrests'] = int(cells['arrests'].sum())
+        if 'Primary Type' in cells.columns:
+            metrics['crime_types'] = int(cells['Primary Type'].nunique())
+        if 'Year' in cells.columns and len(cells):
+            metrics['year_min'] = python_scalar(cells['Year'].min())
+            metrics['year_max'] = python_scalar(cells['Year'].max())
+        return metrics
+
+
+# Partition columns for the describe() sketches, and summary points per partition
+SKETCH_PARTITIONS = ['Year', 'Primary Type']
+SKETCH_POINTS = 100
+# Timestamp columns the statistics cover too, as describe() did for the parsed Date
+DESCRIBE_DATES = ['Date']
+# Rows of the statistics, in describe()'s order for numbers
+DESCRIBE_STATS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+
+def describe_columns(df):
+    """Columns the statistics cover: numbers, including categoricals of numbers (Year), but not flags,
+    and the DESCRIBE_DATES timestamps."""
+    def numeric(dtype):
+        if isinstance(dtype, pd.CategoricalDtype):
+            return pd.api.types.is_numeric_dtype(dtype.categories)
+        return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+    return [col for col in df.columns
+            if numeric(df[col].dtype) or (col in DESCRIBE_DATES and pd.api.types.is_datetime64_dtype(df[col].dtype))]
+
+
+def numeric_view(df, columns):
+    """`columns` of `df` as numbers: categoricals of numbers as floats, float32 as float64,
+    timestamps as float epoch seconds (see describe_dates()).
+
+    Moments of float32 (compact layout) columns are taken in float64, as
+    DescribeSketch.patch() merges them.
+    """
+    view = df[columns].astype({col: 'float64' for col in columns
+                               if isinstance(df[col].dtype, pd.CategoricalDtype) or df[col].dtype == 'float32'})
+    for col in columns:
+        if pd.api.types.is_datetime64_dtype(df[col].dtype):
+            view[col] = (df[col] - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+    return view
+
+
+def describe_dates(stats, columns=DESCRIBE_DATES):
+    """`stats` (describe() of epoch seconds) with the timestamp `columns` shown as timestamps, to
+    the second, and without a std, as describe() shows datetime columns.
+
+    The column is text, so the table converts to Arrow as it is.
+    """
+    stats = stats.copy()
+    for col in columns:
+        if col in stats.columns:
+            shown = pd.to_datetime(stats[col], unit='s').dt.round('s').dt.strftime('%Y-%m-%d %H:%M:%S')
+            shown['count'], shown['std'] = f"{stats.loc['count', col]:.0f}", np.nan
+            stats[col] = shown
+    return stats
+
+
+def describe_frame(df, columns):
+    """describe() of `columns` of `df`, exactly, laid out like DescribeSketch.describe()."""
+    return describe_dates(numeric_view(df, columns).describe().reindex(DESCRIBE_STATS))
+
+
+class DescribeSketch:
+    """Mergeable per-partition statistics for the numeric columns and Date, like describe().
+
+    For each (Year, Primary Type) partition and numeric column it keeps
+    count/mean/M2/min/max, which merge exactly, and a quantile summary of
+    SKETCH_POINTS values at evenly spaced ranks. Each summary point carries
+    the number of rows up to it, so a merged quantile is off by fewer than
+    n_i / SKETCH_POINTS rows per partition: at most 1 / SKETCH_POINTS of all
+    rows in total. Quartiles interpolate between the two ranks around the
+    exact one, as describe() does, so they are exact when every selected
+    partition has fewer rows than points.
+    """
+
+    def __init__(self, df, partition_by=SKETCH_PARTITIONS, points=SKETCH_POINTS):
+        self.partition_by = [col for col in partition_by if col in df.columns]
+        self.points = points
+        self.columns = describe_columns(df)
+        values = numeric_view(df, self.columns)
+        grouped = values.groupby([df[col] for col in self.partition_by], observed=True)
+        self.keys = grouped.size().rename('rows').reset_index()
+        self.count = grouped.count().to_numpy(dtype=float)
+        self.mean = grouped.mean().to_numpy(dtype=float)
+        # 0, not NaN, where a column is all missing, so patches can add values to it
+        self.m2 = np.nan_to_num(grouped.var(ddof=0).to_numpy(dtype=float)) * self.count
+        self.min = grouped.min().to_numpy(dtype=float)
+        self.max = grouped.max().to_numpy(dtype=float)
+        group_ids = grouped.ngroup().to_numpy()
+        self.summaries = [self._summarize(values[col].to_numpy(dtype=float, na_value=np.nan), group_ids)
+                          for col in self.columns]
+
+    def _summarize(self, values, group_ids):
+        """(partition, value, weight) arrays of every partition's quantile summary."""
+        valid = ~np.isnan(values) & (group_ids >= 0)
+        values, group_ids = values[valid], group_ids[valid]
+        order = np.lexsort((values, group_ids))
+        values, group_ids = values[order], group_ids[order]
+        bounds = np.searchsorted(group_ids, np.arange(len(self.keys) + 1))
+        parts, picks, weights = [], [], []
+        for partition, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            n = stop - start
+            if n == 0:
+                continue
+            # 1-based ranks of the kept values; the weight is the rows since the previous one
+            ranks = np.arange(1, n + 1) if n <= self.points else -(-np.arange(1, self.points + 1) * n // self.points)
+            parts.append(np.full(len(ranks), partition))
+            picks.append(values[start + ranks - 1])
+            weights.append(np.diff(ranks, prepend=0))
+        if not parts:
+            return np.empty(0, dtype=int), np.empty(0), np.empty(0, dtype=int)
+        return np.concatenate(parts), np.concatenate(picks), np.concatenate(weights)
+
+    def nbytes(self):
+        return sum(array.nbytes for summary in self.summaries for array in summary) + self.count.nbytes * 5
+
+    def _partitions(self, keys, frame):
+        """Position in `keys` of each row's partition; -1 if it has none (or a missing key)."""
+        def index(data):
+            return pd.MultiIndex.from_frame(data[self.partition_by].astype(object))
+        return index(keys).get_indexer(index(frame))
+
+    def patch(self, df, rows, before):
+        """Copy of the sketches for `df` (a SegmentedFrame), whose rows `rows` changed; `before` holds their replaced versions.
+
+        Moments merge exactly: the changed values are added and the replaced
+        ones subtracted (Chan et al. with a negative count). Each changed value
+        enters its partition's quantile summary with weight +1 and each
+        replaced one with weight -1, a correction of exactly one rank, so the
+        summaries grow by the changes until the next full build. min and max
+        only widen: a replaced extreme is kept.
+        """
+        patched = copy.copy(self)
+        added = df.take(rows)
+        new_numbers, old_numbers = numeric_view(added, self.columns), numeric_view(before, self.columns)
+        keys = self.keys.drop(columns='rows')
+        new_keys = added[self.partition_by].dropna().drop_duplicates()
+        new_keys = new_keys[self._partitions(keys, new_keys) < 0]
+        keys = pd.concat([keys.astype(object), new_keys.astype(object)], ignore_index=True)
+        keys = keys.astype({col: df.dtypes[col] for col in self.partition_by})
+        n_parts, n_new = len(keys), len(new_keys)
+        new_ids = self._partitions(keys, added)
+        old_ids = self._partitions(keys, before)
+        counted = np.bincount(new_ids[new_ids >= 0], minlength=n_parts) - np.bincount(old_ids[old_ids >= 0], minlength=n_parts)
+        keys['rows'] = np.append(self.keys['rows'].to_numpy(), np.zeros(n_new, dtype=np.int64)) + counted
+        patched.keys = keys
+
+        def grow(array, fill):
+            return np.vstack([array, np.full((n_new, array.shape[1]), fill)])
+        count, mean, m2 = grow(self.count, 0.0), grow(self.mean, np.nan), grow(self.m2, 0.0)
+        low, high = grow(self.min, np.nan), grow(self.max, np.nan)
+        summaries = []
+        # The replaced version of each changed row, if it had one
+        previous = before.index.get_indexer(rows)
+        for j, col in enumerate(self.columns):
+            new_values = new_numbers[col].to_numpy(dtype=float, na_value=np.nan)
+            old_values = old_numbers[col].to_numpy(dtype=float, na_value=np.nan)
+            # Rows whose partition and value did not change need no correction
+            has_old = previous >= 0
+            unchanged = np.zeros(len(rows), dtype=bool)
+            unchanged[has_old] = ((new_ids[has_old] == old_ids[previous[has_old]])
+                                  & ((new_values[has_old] == old_values[previous[has_old]])
+                                     | (np.isnan(new_values[has_old]) & np.isnan(old_values[previous[has_old]]))))
+            removed = np.ones(len(before), dtype=bool)
+            removed[previous[unchanged]] = False
+            add_ids, add_values = self._valid(new_ids[~unchanged], new_values[~unchanged])
+            drop_ids, drop_values = self._valid(old_ids[removed], old_values[removed])
+            for ids, values, sign in [(add_ids, add_values, 1), (drop_ids, drop_values, -1)]:
+                n = np.bincount(ids, minlength=n_parts).astype(float)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    part_mean = np.bincount(ids, weights=values, minlength=n_parts) / n
+                part_m2 = np.bincount(ids, weights=(values - part_mean[ids]) ** 2, minlength=n_parts)
+                count[:, j], mean[:, j], m2[:, j] = _merge_moments(count[:, j], mean[:, j], m2[:, j],
+                                                                   sign * n, part_mean, sign * part_m2)
+            np.fmin.at(low[:, j], add_ids, add_values)
+            np.fmax.at(high[:, j], add_ids, add_values)
+            parts, picks, weights = self.summaries[j]
+            summaries.append((np.concatenate([parts, add_ids, drop_ids]),
+                              np.concatenate([picks, add_values, drop_values]),
+                              np.concatenate([weights, np.ones(len(add_ids), dtype=weights.dtype),
+                                              -np.ones(len(drop_ids), dtype=weights.dtype)])))
+        patched.count, patched.mean, patched.m2, patched.min, patched.max = count, mean, m2, low, high
+        patched.summaries = summaries
+        return patched
+
+    @staticmethod
+    def _valid(ids, values):
+        keep = (ids >= 0) & ~np.isnan(values)
+        return ids[keep], values[keep]
+
+    def covers(self, filters):
+        """True if `filters` only restricts partition columns, so the sketches can answer it."""
+        return all(col in self.partition_by for col, selected in filters.items() if len(selected))
+
+    def describe(self, filters):
+        """(describe()-style frame, max quantile rank error as a fraction of rows)."""
+        mask = np.ones(len(self.keys), dtype=bool)
+        for col, selected in filters.items():
+            if len(selected):
+                mask &= self.keys[col].isin(list(selected)).to_numpy(dtype=bool)
+        count = self.count[mask].sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Partitions where a column is all missing have count 0 and a NaN mean
+            mean = np.nansum(self.count[mask] * self.mean[mask], axis=0) / count
+            # Chan et al. parallel variance: M2 = sum(M2_i + n_i * (mean_i - mean)^2)
+            m2 = np.nansum(self.m2[mask] + self.count[mask] * (self.mean[mask] - mean) ** 2, axis=0)
+            std = np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+        stats = {
+            'count': count, 'mean': mean, 'std': std,
+            'min': np.nanmin(self.min[mask], axis=0, initial=np.inf),
+            '25%': [], '50%': [], '75%': [],
+            'max': np.nanmax(self.max[mask], axis=0, initial=-np.inf),
+        }
+        for i, (parts, picks, weights) in enumerate(self.summaries):
+            keep = mask[parts]
+            for label, q in zip(['25%', '50%', '75%'], self._quantiles(picks[keep], weights[keep], [0.25, 0.5, 0.75])):
+                stats[label].append(q)
+        result = pd.DataFrame(stats, index=self.columns).T
+        result.loc[['min', 'max'], count == 0] = np.nan
+        result = describe_dates(result)
+        rows = self.keys['rows'].to_numpy()[mask]
+        large = rows[rows > self.points].sum()
+        error = large / self.points / rows.sum() if rows.sum() else 0.0
+        return result, error
+
+    @staticmethod
+    def _quantiles(picks, weights, probabilities):
+        if len(picks) == 0:
+            return [np.nan] * len(probabilities)
+        # Net the weights of equal values; patches add points of weight -1, and where one has no
+        # equal point to cancel, the running maximum keeps the ranks non-decreasing
+        picks, inverse = np.unique(picks, return_inverse=True)
+        cumulative = np.maximum.accumulate(np.cumsum(np.bincount(inverse, weights=weights)))
+        if cumulative[-1] <= 0:
+            return [np.nan] * len(probabilities)
+
+        def at_rank(ranks):
+            # Value at 0-based rank: the first point with more rows up to it
+            positions = np.searchsorted(cumulative, ranks + 1, side='left')
+            return picks[np.minimum(positions, len(picks) - 1)]
+        # Linear interpolation between the ranks around (n - 1) * q, like describe()
+        ranks = (cumulative[-1] - 1) * np.asarray(probabilities)
+        low, high = at_rank(np.floor(ranks)), at_rank(np.ceil(ranks))
+        return low + (ranks - np.floor(ranks)) * (high - low)
+
+
+def _merge_moments(count, mean, m2, count_b, mean_b, m2_b):
+    """count/mean/M2 of two sets of values combined (Chan et al.); a negative count_b
+    (and M2) takes set b back out. Columns without any values get a NaN mean."""
+    total = count + count_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.nan_to_num(mean_b) - np.nan_to_num(mean)
+        merged_mean = np.where(count_b == 0, mean, np.nan_to_num(mean) + delta * count_b / total)
+        merged_m2 = np.where(count_b == 0, m2, m2 + m2_b + delta ** 2 * count * count_b / total)
+    empty = total <= 0
+    return np.where(empty, 0.0, total), np.where(empty, np.nan, merged_mean), np.where(empty, 0.0, np.maximum(merged_m2, 0.0))
+
+
+# Bucket sizes of the time rollups, as pandas frequencies (weeks start on Monday)
+TIME_GRAINS = {'hour': 'h', 'day': 'D', 'week': 'W-MON', 'month': 'MS', 'year': 'YS'}
+# Column label for rows without a category in a split series
+MISSING_CATEGORY = '(missing)'
+
+
+def fill_buckets(starts, counts, grain, columns=None, window=None):
+    """Series of `counts` per sorted bucket start, or a DataFrame of them with `columns`.
+
+    Spans the first to the last bucket with the empty buckets in between
+    filled with 0, and drops all-zero columns; `window` (in buckets) turns
+    the counts into a trailing rolling mean.
+    """
+    if len(starts):
+        index = pd.date_range(starts[0], starts[-1], freq=TIME_GRAINS[grain])
+    else:
+        index = pd.DatetimeIndex([])
+    # Scatter the buckets with incidents into the full, gap-free range
+    filled = np.zeros((len(index),) + counts.shape[1:], dtype=np.int64)
+    filled[index.get_indexer(starts)] = counts
+    if columns is not None:
+        result = pd.DataFrame(filled, index=index, columns=columns)
+        result = result.loc[:, filled.sum(axis=0) > 0]
+    else:
+        result = pd.Series(filled, index=index)
+    if window and window > 1:
+        result = result.rolling(window, min_periods=1).mean()
+    return result
+
+
+def top_columns(frame, n=5, window=None):
+    """The `n` columns of `frame` with the largest totals, the rest summed as 'Other'."""
+    top = frame.sum().sort_values(ascending=False).index[:n]
+    result = frame[top]
+    if len(frame.columns) > n:
+        result = result.assign(Other=frame.drop(columns=top).sum(axis=1))
+    if window and window > 1:
+        result = result.rolling(window, min_periods=1).mean()
+    return result
+
+
+class TimeRollup:
+    """Incident counts per hour of `column` and value of `category`, re-bucketed on demand.
+
+    The hour x category table of all rows is built once. Coarser grains sum
+    contiguous runs of hours (np.add.reduceat), and a row selection counts
+    its rows' precomputed hour and category codes with one bincount. The
+    codes of the loaded rows are kept as built; rows changed by incremental
+    updates have codes of their own (see patch).
+    """
+
+    def __init__(self, df, column='Date', category='Primary Type'):
+        self.column, self.category = column, category
+        stamps = df[column].to_numpy(dtype='datetime64[h]')
+        valid = ~np.isnat(stamps)
+        # Only hours with incidents are kept; the series are filled out per grain
+        self.hours, codes = np.unique(stamps[valid], return_inverse=True)
+        self.row_hours = np.full(len(df), -1, dtype=np.int32)
+        self.row_hours[valid] = codes
+        if category in df.columns:
+            values = df[category]
+            self.categories = list(values.cat.categories) + [MISSING_CATEGORY]
+            self.row_categories = values.cat.codes.to_numpy().astype(np.int16)
+            self.row_categories[self.row_categories < 0] = len(self.categories) - 1
+        else:
+            self.categories = [MISSING_CATEGORY]
+            self.row_categories = np.zeros(len(df), dtype=np.int16)
+        # Current code of each hour code in row_hours; None while they are still current
+        self.hour_map = None
+        self.changed_rows = np.empty(0, dtype=np.int64)
+        self.changed_hours = np.empty(0, dtype=np.int32)
+        self.changed_categories = np.empty(0, dtype=np.int16)
+        self.table = self._table(self.row_hours, self.row_categories)
+        self.totals = self.table.sum(axis=1)
+        self._buckets = {}
+
+    def nbytes(self):
+        return (self.hours.nbytes + self.row_hours.nbytes + self.row_categories.nbytes
+                + self.changed_hours.nbytes + self.changed_categories.nbytes
+                + self.table.nbytes + self.totals.nbytes)
+
+    def patch(self, df, rows, before):
+        """Copy of the rollups for `df` (a SegmentedFrame), whose rows `rows` changed; `before`
+        holds their replaced versions.
+
+        The replaced versions' cells are decremented and the changed rows'
+        incremented. New hours are merged into the sorted hours and new
+        categories appended after the existing ones. The loaded rows' codes
+        are left as built (hour_map translates their hours); the changed
+        rows get codes of their own, so a patch costs the changes, not the rows.
+        """
+        patched = copy.copy(self)
+        added = df.take(rows, [col for col in [self.column, self.category] if col in df.columns])
+        stamps = added[self.column].to_numpy(dtype='datetime64[h]')
+        stamps = stamps[~np.isnat(stamps)]
+        new_hours = np.unique(stamps[~contains(self.hours, stamps)])
+        categories = list(self.categories)
+        if self.category in df.columns:
+            known = set(categories)
+            categories += [value for value in df.dtypes[self.category].categories if value not in known]
+
+        if len(new_hours) or len(categories) != len(self.categories):
+            hours = np.insert(self.hours, np.searchsorted(self.hours, new_hours), new_hours)
+            # Each existing hour moves up by the number of new hours before it
+            hour_codes = (np.arange(len(self.hours)) + np.searchsorted(new_hours, self.hours)).astype(np.int32)
+            hour_map = hour_codes if self.hour_map is None else hour_codes[self.hour_map]
+            # Hours appended after the existing ones (daily updates) leave the codes as they are
+            patched.hour_map = None if not len(hour_map) or hour_map[-1] == len(hour_map) - 1 else hour_map
+            table = np.zeros((len(hours), len(categories)), dtype=np.int32)
+            table[np.ix_(hour_codes, pd.Index(categories).get_indexer(self.categories))] = self.table
+        else:
+            hours, table = self.hours, self.table.copy()
+        patched.hours, patched.categories = hours, categories
+        patched.changed_rows = df.rows
+        patched.changed_hours, patched.changed_categories = patched._codes(df.changes)
+        # Take the replaced versions out, then count the new ones in
+        self._add(table, *patched._codes(before), -1)
+        self._add(table, *patched._codes(added), 1)
+        patched.table, patched.totals = table, table.sum(axis=1)
+        if len(hours) != len(self.hours):
+            patched._buckets = {}
+        return patched
+
+    def _codes(self, frame):
+        """Hour and category codes of the rows of `frame`, in this rollup's hours and categories."""
+        stamps = frame[self.column].to_numpy(dtype='datetime64[h]')
+        hours = np.where(np.isnat(stamps), -1, np.searchsorted(self.hours, stamps)).astype(np.int32)
+        missing = self.categories.index(MISSING_CATEGORY)
+        if self.category in frame.columns:
+            codes = pd.Index(self.categories).get_indexer(frame[self.category])
+            categories = np.where(codes >= 0, codes, missing).astype(np.int16)
+        else:
+            categories = np.full(len(frame), missing, dtype=np.int16)
+        return hours, categories
+
+    @staticmethod
+    def _add(table, hours, categories, sign):
+        keep = hours >= 0
+        np.add.at(table, (hours[keep], categories[keep]), sign)
+
+    def _count(self, rows):
+        """hours x categories count table for row positions `rows`."""
+        if not len(self.changed_rows):
+            return self._table(self.row_hours[rows], self.row_categories[rows])
+        # Loaded rows through their codes as built, changed rows through their own
+        changed = contains(self.changed_rows, rows)
+        loaded = rows[~changed]
+        hours = self.row_hours[loaded]
+        if self.hour_map is not None:
+            hours = np.where(hours >= 0, self.hour_map[hours], -1)
+        at = np.searchsorted(self.changed_rows, rows[changed])
+        return self._table(np.concatenate([hours, self.changed_hours[at]]),
+                           np.concatenate([self.row_categories[loaded], self.changed_categories[at]]))
+
+    def _table(self, hours, categories):
+        """hours x categories count table of the rows with these codes (hour -1: no date)."""
+        keep = hours >= 0
+        width = len(self.categories)
+        cells = hours[keep].astype(np.int64) * width + categories[keep]
+        counts = np.bincount(cells, minlength=len(self.hours) * width)
+        return counts.reshape(len(self.hours), width).astype(np.int32)
+
+    def _bucket_offsets(self, grain):
+        """Start of each `grain` bucket holding incidents, and its first position in self.hours."""
+        if grain not in self._buckets:
+            hours = self.hours
+            if grain == 'hour':
+                starts = hours
+            elif grain == 'day':
+                starts = hours.astype('datetime64[D]')
+            elif grain == 'week':
+                days = hours.astype('datetime64[D]')
+                # The epoch (1970-01-01) was a Thursday: shift to the week's Monday
+                starts = days - (days.astype(np.int64) + 3) % 7
+            elif grain == 'month':
+                starts = hours.astype('datetime64[M]')
+            elif grain == 'year':
+                starts = hours.astype('datetime64[Y]')
+            else:
+                raise ValueError(f"Unknown time grain {grain!r}; use one of {list(TIME_GRAINS)}")
+            # self.hours is sorted, so each bucket is a contiguous run of hours
+            starts, offsets = np.unique(starts, return_index=True)
+            self._buckets[grain] = (starts.astype('datetime64[ns]'), offsets)
+        return self._buckets[grain]
+
+    def counts(self, rows=None, grain='day', by_category=False, window=None):
+        """Incidents per `grain` bucket for row positions `rows` (None for all rows).
+
+        Buckets without incidents are filled with 0. A Series of totals, or a
+        DataFrame with a column per category when `by_category`; `window`
+        (in buckets) turns the counts into a trailing rolling mean.
+        """
+        if rows is None:
+            table = self.table if by_category else self.totals
+        else:
+            table = self._count(rows)
+            table = table if by_category else table.sum(axis=1)
+        starts, offsets = self._bucket_offsets(grain)
+        bucketed = np.add.reduceat(table, offsets, axis=0) if len(offsets) else table[:0]
+        # Span the selection's first to last incident, not the whole dataset's
+        occupied = np.flatnonzero(bucketed.sum(axis=1) if by_category else bucketed)
+        if len(occupied):
+            starts = starts[occupied[0]:occupied[-1] + 1]
+            bucketed = bucketed[occupied[0]:occupied[-1] + 1]
+        else:
+            starts, bucketed = starts[:0], bucketed[:0]
+        return fill_buckets(starts, bucketed, grain, self.categories if by_category else None, window)
+
+    def top_categories(self, rows=None, grain='day', n=5, window=None):
+        """counts() by category, keeping the `n` largest categories and summing the rest as 'Other'."""
+        return top_columns(self.counts(rows, grain, by_category=True), n, window)
+
+    def profile(self, rows=None, by='hour'):
+        """Incidents per hour of the day (0-23), or per day of the week (0 = Monday) for by='weekday'."""
+        totals = self.totals if rows is None else self._count(rows).sum(axis=1)
+        hours = self.hours.astype(np.int64)
+        # The epoch (1970-01-01) was a Thursday, day 3 of a Monday-first week
+        slots, size = (hours % 24, 24) if by == 'hour' else ((hours // 24 + 3) % 7, 7)
+        return pd.Series(np.bincount(slots, weights=totals, minlength=size).astype(np.int64))
@@ -0,0 +1,51 @@
+"""Chart specs and rendering for the dashboard's Visualizations tab.
+
+A spec is a plain dict (kind, data, labels, colors) built from cached
+rollups. It is rendered either server-side to PNG bytes, or client-side by
+handing the data to Streamlit's native (Vega-Lite) charts.
+"""
+from io import BytesIO
+
+from matplotlib.colors import to_hex
+from matplotlib.figure import Figure
+
+FIGSIZE = (12, 6)
+
+
+def chart_spec(kind, data, title, xlabel, ylabel, color, grid=False):
+    """Everything needed to draw one chart. `kind` is 'barh' or 'line'."""
+    return {'kind': kind, 'data': data, 'title': title, 'xlabel': xlabel,
+            'ylabel': ylabel, 'color': color, 'grid': grid}
+
+
+def render_png(spec, dpi=100):
+    """Draw `spec` with matplotlib and return PNG bytes.
+
+    Uses a standalone Figure rather than pyplot, so nothing is kept in the
+    pyplot figure registry and the figure is freed as soon as this returns.
+    """
+    fig = Figure(figsize=FIGSIZE, dpi=dpi)
+    ax = fig.subplots()
+    if spec['kind'] == 'line':
+        # Markers only while individual points are still distinguishable
+        marker = 'o' if len(spec['data']) <= 100 else None
+        spec['data'].plot(kind='line', ax=ax, marker=marker, color=spec['color'])
+    else:
+        spec['data'].plot(kind=spec['kind'], ax=ax, color=spec['color'])
+    ax.set_xlabel(spec['xlabel'])
+    ax.set_ylabel(spec['ylabel'])
+    ax.set_title(spec['title'])
+    if spec['grid']:
+        ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    fig.clear()
+    return buffer.getvalue()
+
+
+def client_colors(spec):
+    """The spec's color(s) as hex strings, the format Streamlit's native charts take."""
+    if isinstance(spec['color'], (list, tuple)):
+        return [to_hex(color) for color in spec['color']]
+    return to_hex(spec['color'])
@@ -0,0 +1,373 @@
+"""Data loading helpers for the Chicago crime dashboard (streamlit-app.py)."""
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from pandas.api.types import union_categoricals
+
+# Typed snapshots are written next to the CSV in this folder
+SNAPSHOT_DIR = '.crime_cache'
+# Bump when the typed layout changes so old snapshots are not reused
+SNAPSHOT_VERSION = 5
+# Shared-memory (tmpfs) folder for snapshots mapped by every dashboard process on the host
+SHARED_DIR = os.environ.get('CRIME_SHARED_DIR', '/dev/shm/crime-dashboard')
+
+# Timestamp columns, stored as datetime64[s] (int64 seconds since the epoch)
+DATE_COLUMNS = ['Date', 'Updated On']
+# Known timestamp layouts, tried in order: the portal's CSV export, then its API
+DATE_FORMATS = ['%m/%d/%Y %I:%M:%S %p', '%Y-%m-%dT%H:%M:%S.%f']
+BOOL_COLUMNS = ['Arrest', 'Domestic']
+# Sidebar filter columns, stored as ordered categoricals (sorted categories)
+CATEGORY_COLUMNS = ['Year', 'Primary Type', 'Location Description']
+
+# CSVs larger than this are ingested in chunks instead of read whole
+STREAM_THRESHOLD_MB = float(os.environ.get('CRIME_STREAM_THRESHOLD_MB', 256))
+CHUNK_ROWS = 250_000
+# Redundant columns left out of the streamed store (Location repeats Latitude/Longitude)
+DROP_COLUMNS = ['Location']
+# Fixed read dtypes for whole files, chunks and shards alike (every other column is
+# read as TEXT_DTYPE), so the frame gets the same types whatever values a file or a
+# piece of it happens to hold: area codes are nullable ints whether or not any is missing
+CSV_DTYPES = {
+    'ID': 'int64', 'Year': 'Int64',
+    'Beat': 'Int64', 'District': 'Int64', 'Ward': 'Int64', 'Community Area': 'Int64',
+    'X Coordinate': 'float64', 'Y Coordinate': 'float64', 'Latitude': 'float64', 'Longitude': 'float64',
+}
+# pandas' default string dtype, as it infers for text
+TEXT_DTYPE = 'str'
+
+# Compact layout (load_crime_data(compact=True)): repetitive text as sorted dictionaries
+# (categoricals), area codes as nullable small ints, coordinates as float32 (~1 m at
+# Chicago's latitude), and no Location. Fixed like CSV_DTYPES, so every chunk agrees.
+DICTIONARY_COLUMNS = ['Block', 'IUCR', 'Description', 'FBI Code']
+COMPACT_DTYPES = {
+    'ID': 'int32', 'Beat': 'Int16', 'District': 'Int8', 'Ward': 'Int8', 'Community Area': 'Int8',
+    'X Coordinate': 'float32', 'Y Coordinate': 'float32', 'Latitude': 'float32', 'Longitude': 'float32',
+}
+
+
+def to_bool(series):
+    """Coerce a True/False text column to bool (nullable if values are missing)."""
+    if series.dtype == bool:
+        return series
+    values = series.astype('string').str.strip().str.lower()
+    result = values.map({'true': True, 'false': False}).astype('boolean')
+    return result.astype(bool) if not result.isna().any() else result
+
+
+def parse_timestamps(series):
+    """Parse timestamp strings to datetime64[s]; unparseable values become NaT.
+
+    Timestamps repeat heavily, so only the unique strings are parsed: first
+    with each of DATE_FORMATS, then with pandas' mixed-format parser for
+    whatever is left. The result is broadcast back with the factorized codes.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.astype('datetime64[s]')
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[s]')
+    pending = uniques.index
+    for fmt in DATE_FORMATS:
+        if len(pending) == 0:
+            break
+        parsed[pending] = pd.to_datetime(uniques[pending], format=fmt, errors='coerce')
+        pending = pending[parsed[pending].isna().to_numpy()]
+    if len(pending):
+        parsed[pending] = pd.to_datetime(uniques[pending], format='mixed', errors='coerce')
+    # Missing strings have code -1, which picks the NaT appended at the end
+    values = np.append(parsed.to_numpy(), np.datetime64('NaT', 's'))
+    return pd.Series(values[codes], index=series.index, name=series.name)
+
+
+def epoch_seconds(series):
+    """int64 seconds since the epoch of a datetime64[s] column (NaT as the int64 minimum)."""
+    return series.to_numpy(dtype='datetime64[s]').view('int64')
+
+
+def coerce_types(df, categories=True):
+    """Apply the dashboard's column types to a freshly parsed crime frame."""
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = parse_timestamps(df[col])
+    # Convert Year to numeric if it exists
+    if 'Year' in df.columns:
+        df['Year'] = pd.to_numeric(df['Year'], errors='coerce')
+    for col in BOOL_COLUMNS:
+        if col in df.columns:
+            df[col] = to_bool(df[col])
+    if categories:
+        for col in CATEGORY_COLUMNS:
+            if col in df.columns:
+                df[col] = to_category(df[col])
+    return df
+
+
+def compact_types(df, categories=True):
+    """Convert a typed crime frame to the compact layout (see COMPACT_DTYPES)."""
+    df = df.drop(columns=[col for col in DROP_COLUMNS if col in df.columns])
+    for col, dtype in COMPACT_DTYPES.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+    if categories:
+        for col in DICTIONARY_COLUMNS:
+            if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = to_category(df[col])
+    return df
+
+
+def to_category(series):
+    categories = np.sort(series.dropna().unique())
+    return pd.Categorical(series, categories=categories, ordered=True)
+
+
+def order_categories(series):
+    """Sort the categories of an (unordered) categorical and mark it ordered."""
+    return series.cat.reorder_categories(np.sort(series.cat.categories.to_numpy())).cat.as_ordered()
+
+
+def category_options(dtype):
+    """Sorted filter options, read from a categorical column's dtype."""
+    return list(dtype.categories)
+
+
+def read_crime_csv(path):
+    _, dtypes = csv_dtypes(path)
+    return coerce_types(pd.read_csv(path, dtype=dtypes))
+
+
+def find_shards(folder):
+    """The CSV shards (e.g. one per year) in `folder`, in name order."""
+    return sorted(glob.glob(os.path.join(folder, '*.csv')))
+
+
+def csv_dtypes(path, drop=()):
+    """Columns of a crime CSV (less `drop`) and their fixed read dtypes.
+
+    Pinning the dtypes stops per-file (or per-chunk) inference from typing a
+    column differently in different pieces, e.g. IUCR codes as ints where
+    no code has a leading zero.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    columns = [col for col in header if col not in drop]
+    return columns, {col: CSV_DTYPES.get(col, TEXT_DTYPE) for col in columns}
+
+
+def _read_shard(path):
+    """Typed frame of one shard and its parse time; runs in a pool worker."""
+    start = time.perf_counter()
+    columns, dtypes = csv_dtypes(path)
+    df = coerce_types(pd.read_csv(path, usecols=columns, dtype=dtypes))
+    return df, time.perf_counter() - start
+
+
+def read_shards(folder, workers=None):
+    """Parse every shard in `folder` in a process pool and concatenate them.
+
+    Each shard is typed in its worker, categoricals included; the parent
+    only unions the (small) categories and remaps codes. The per-shard
+    timings are kept in df.attrs['shards'].
+    """
+    paths = find_shards(folder)
+    if not paths:
+        raise FileNotFoundError(f"No CSV shards in {folder}")
+    start = time.perf_counter()
+    if workers == 1 or len(paths) == 1:
+        results = [_read_shard(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_read_shard, paths))
+    frames = [frame for frame, _ in results]
+    columns = list(frames[0].columns)
+    categories = [col for col in CATEGORY_COLUMNS if col in columns]
+    df = pd.concat([frame.drop(columns=categories) for frame in frames], ignore_index=True)
+    for col in categories:
+        # Shards see different subsets of values: union their categories, sorted
+        merged = union_categoricals([frame[col] for frame in frames], sort_categories=True, ignore_order=True)
+        df[col] = merged.as_ordered()
+    df = df[columns]
+    df.attrs['shards'] = [{'shard': os.path.basename(path), 'rows': len(frame), 'seconds': seconds}
+                          for path, (frame, seconds) in zip(paths, results)]
+    df.attrs['load_seconds'] = time.perf_counter() - start
+    return df
+
+
+def read_crime_data(path, workers=None):
+    """Read a CSV file, or a directory of CSV shards, into a typed frame."""
+    if os.path.isdir(path):
+        return read_shards(path, workers)
+    return read_crime_csv(path)
+
+
+def snapshot_path(path, folder=None, version=SNAPSHOT_VERSION, ext='.arrow', compact=False):
+    """Snapshot file for `path`, keyed by the CSV's (or its shards') size and mtime.
+
+    Snapshots go in .crime_cache/ next to the data unless `folder` is given.
+    `version` and `ext` name other stores kept alongside (e.g. SQL databases);
+    compact-layout snapshots have a stem of their own, so both layouts can be kept.
+    """
+    path = os.path.abspath(path)
+    stem = os.path.splitext(os.path.basename(path))[0] + ('.compact' if compact else '')
+    if os.path.isdir(path):
+        stats = [(os.path.basename(shard), os.stat(shard)) for shard in find_shards(path)]
+        size = sum(stat.st_size for _, stat in stats)
+        # Any added, removed, renamed or touched shard changes the key
+        digest = hashlib.sha1(repr([(name, stat.st_size, stat.st_mtime_ns) for name, stat in stats]).encode())
+        key = f"{size}-{digest.hexdigest()[:16]}"
+        local = os.path.join(path, SNAPSHOT_DIR)
+    else:
+        stat = os.stat(path)
+        key = f"{stat.st_size}-{stat.st_mtime_ns}"
+        local = os.path.join(os.path.dirname(path), SNAPSHOT_DIR)
+    if folder is None:
+        folder = local
+    else:
+        # A shared folder holds snapshots of many datasets: tell same-named ones apart
+        stem = f"{stem}_{hashlib.sha1(path.encode()).hexdigest()[:8]}"
+    return os.path.join(folder, f"{stem}-v{version}-{key}{ext}")
+
+
+def publish_snapshot(tmp, snap):
+    """Move a finished snapshot into place and remove stale ones of the same CSV."""
+    os.replace(tmp, snap)
+    folder = os.path.dirname(snap)
+    stem = os.path.basename(snap).rsplit('-', 3)[0]
+    ext = os.path.splitext(snap)[1]
+    # Snapshots of older versions of the same CSV are stale now
+    for name in os.listdir(folder):
+        old = os.path.join(folder, name)
+        if old != snap and name.endswith(ext) and name.rsplit('-', 3)[0] == stem:
+            os.remove(old)
+
+
+def snapshot_table(df):
+    """Arrow table of `df`, laid out so that reading it back maps rather than copies.
+
+    Every column is one contiguous chunk, so nothing is concatenated on read,
+    and floats keep NaN as a value instead of a null, so nothing is NaN-filled.
+    """
+    # Arrow would persist df.attrs; load timings must not outlive this load
+    df = df.copy(deep=False)
+    df.attrs = {}
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, col in enumerate(df.columns):
+        if isinstance(df[col].dtype, np.dtype) and df[col].dtype.kind == 'f':
+            table = table.set_column(i, table.field(i), pa.array(df[col].to_numpy(), type=table.field(i).type))
+    return table.combine_chunks()
+
+
+def write_snapshot(df, snap):
+    """Write `df` as an uncompressed, single-batch Arrow IPC file so it can be memory-mapped."""
+    os.makedirs(os.path.dirname(snap), exist_ok=True)
+    tmp = f"{snap}.{os.getpid()}.tmp"
+    feather.write_feather(snapshot_table(df), tmp, compression='uncompressed', chunksize=max(len(df), 1))
+    publish_snapshot(tmp, snap)
+
+
+def ingest_csv(path, snap, chunksize=CHUNK_ROWS, compact=False):
+    """Stream a CSV into an Arrow IPC snapshot, one typed chunk at a time.
+
+    Only one chunk is held in memory, in either of two passes. The first
+    parses the text into a scratch file of typed chunks, with the dictionary
+    columns as plain values, and collects those columns' values. The second
+    reads the scratch file back one batch at a time, encodes the
+    dictionary columns against the complete sorted dictionaries, and appends
+    the batch to the snapshot. `compact` stores the compact layout (see
+    COMPACT_DTYPES).
+
+    The snapshot thus holds one record batch per chunk. Loading it joins each
+    column's batches into one array, a private copy in every process, where a
+    snapshot written whole (write_snapshot) is mapped as it is.
+    """
+    os.makedirs(os.path.dirname(snap), exist_ok=True)
+    scratch = f"{snap}.{os.getpid()}.chunks"
+    columns, dtypes = csv_dtypes(path, drop=DROP_COLUMNS)
+    dictionaries = [col for col in CATEGORY_COLUMNS + (DICTIONARY_COLUMNS if compact else []) if col in columns]
+    seen = {col: pd.Index([]) for col in dictionaries}
+    schema = None
+    writer = None
+    try:
+        for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunksize):
+            chunk = coerce_types(chunk[columns], categories=False)
+            if compact:
+                chunk = compact_types(chunk, categories=False)
+            for col in dictionaries:
+                seen[col] = seen[col].append(pd.Index(chunk[col].dropna().unique())).unique()
+            if schema is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                writer = pa.ipc.new_file(scratch, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # Header only: nothing was streamed
+        df = coerce_types(pd.read_csv(path, usecols=columns, dtype=dtypes))
+        write_snapshot(compact_types(df) if compact else df, snap)
+        return
+    # The categorical types the whole column would get (see to_category)
+    categories = {col: to_category(pd.Series(values)).dtype for col, values in seen.items()}
+    tmp = f"{snap}.{os.getpid()}.tmp"
+    writer = None
+    try:
+        with pa.OSFile(scratch) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                table = snapshot_table(reader.get_batch(i).to_pandas().astype(categories))
+                if writer is None:
+                    writer = pa.ipc.new_file(tmp, table.schema)
+                writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+        os.remove(scratch)
+    publish_snapshot(tmp, snap)
+
+
+def read_snapshot(snap):
+    return feather.read_table(snap, memory_map=True).to_pandas(split_blocks=True)
+
+
+def load_crime_data(path='dataset.csv', snapshot=True, workers=None, folder=None, compact=False):
+    """Load the crime CSV (or directory of CSV shards), reusing a typed snapshot when unchanged.
+
+    The frame is served from the memory-mapped snapshot (in `folder`, see
+    snapshot_path()): its columns are read-only views of the file's pages,
+    which every process mapping the same snapshot shares.
+
+    CSVs over STREAM_THRESHOLD_MB are streamed into the snapshot in chunks
+    first, so they never have to fit in memory as text; such a snapshot is
+    read into private memory instead (see ingest_csv). Shards are parsed by
+    `workers` processes (default: one per core).
+
+    `compact` serves the compact layout (see COMPACT_DTYPES) instead.
+    """
+    if not snapshot:
+        df = read_crime_data(path, workers)
+        return compact_types(df) if compact else df
+    snap = snapshot_path(path, folder, compact=compact)
+    if os.path.exists(snap):
+        try:
+            return read_snapshot(snap)
+        except (OSError, pa.ArrowInvalid):
+            pass  # Unreadable snapshot - rebuild it from the CSV below
+    if os.path.isfile(path) and os.path.getsize(path) > STREAM_THRESHOLD_MB * 1024 * 1024:
+        ingest_csv(path, snap, compact=compact)
+        return read_snapshot(snap)
+    df = read_crime_data(path, workers)
+    if compact:
+        df = compact_types(df)
+    try:
+        write_snapshot(df, snap)
+    except OSError:
+        return df  # Read-only data folder - keep serving from the parsed CSV
+    # Swap the parsed copy for the mapped one, keeping the load's attrs (shard timings)
+    mapped = read_snapshot(snap)
+    mapped.attrs = df.attrs
+    return mapped
@@ -0,0 +1,332 @@
+"""Prebuilt row indexes for the Chicago crime dashboard's filters."""
+import copy
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# Sidebar filter columns covered by the filter index
+FILTER_COLUMNS = ['Year', 'Primary Type', 'Location Description', 'Arrest']
+# A bitmap per value costs values / 8 bytes per row; columns with more values than
+# this (Location Description) are answered from their category codes instead
+BITMAP_MAX_VALUES = 40
+
+
+class FilterIndex:
+    """Inverted index of the filter columns: packed row bitmaps, one per value, for
+    the columns with few values, and the row codes for the others.
+
+    A selection ORs the bitmaps of the chosen values within a column (or looks
+    up each row's code) and ANDs the columns together, so the frame itself is
+    only touched by one `take`. The codes of a categorical column are the
+    frame's own, so they cost no memory of their own. Rows changed by
+    incremental updates are tested apart (see patch).
+    """
+
+    def __init__(self, df, columns=FILTER_COLUMNS, max_bitmaps=BITMAP_MAX_VALUES):
+        self.n_rows = len(df)
+        self.values = {}
+        self.bitmaps = {}
+        self.codes = {}
+        self._owned = set()  # Columns whose codes were built here, not read from a categorical
+        for col in columns:
+            if col in df.columns:
+                self._build(col, df[col], max_bitmaps)
+        self.changed_rows = np.empty(0, dtype=np.int64)
+        self.changes = None
+
+    def _build(self, col, series, max_bitmaps):
+        categorical = isinstance(series.dtype, pd.CategoricalDtype)
+        if categorical:
+            values, codes = series.cat.categories, series.cat.codes.to_numpy()
+        else:
+            codes, values = pd.factorize(series, sort=True)
+            codes = codes.astype(np.int16 if len(values) < 2**15 else np.int32)
+        self.values[col] = values
+        if len(values) > max_bitmaps:
+            self.codes[col] = codes
+            if not categorical:
+                self._owned.add(col)
+            return
+        # One row of packed bits (n_rows / 8 bytes) per value
+        bitmaps = np.zeros((len(values), (self.n_rows + 7) // 8), dtype=np.uint8)
+        for i in range(len(values)):
+            bitmaps[i] = np.packbits(codes == i)
+        self.bitmaps[col] = bitmaps
+
+    def nbytes(self):
+        return (sum(bitmaps.nbytes for bitmaps in self.bitmaps.values())
+                + sum(self.codes[col].nbytes for col in self._owned))
+
+    def patch(self, df):
+        """Copy of the index for `df` (a SegmentedFrame), reading its changed rows and their values.
+
+        The bitmaps stay those of the loaded rows. select() skips the changed
+        rows in them and tests those rows' current values instead, so a patch
+        copies nothing and the original stays valid for the reruns reading it.
+        """
+        patched = copy.copy(self)
+        patched.changed_rows = df.rows
+        patched.changes = df.changes[list(self.values)]
+        return patched
+
+    def column_bits(self, col, selected):
+        """Packed bitmap of the rows whose `col` is any of `selected`."""
+        positions = self.values[col].get_indexer(list(selected))
+        positions = positions[positions >= 0]
+        if col in self.codes:
+            # Look each row's code up (the extra last entry is for code -1, missing)
+            wanted = np.zeros(len(self.values[col]) + 1, dtype=bool)
+            wanted[positions] = True
+            return np.packbits(wanted[self.codes[col]])
+        if len(positions) == 0:
+            return np.zeros(self.bitmaps[col].shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[col][positions], axis=0)
+
+    def select_bits(self, filters):
+        """AND of the per-column bitmaps, or None when nothing is filtered."""
+        bits = None
+        for col, selected in filters.items():
+            if col not in self.values or not selected:
+                continue
+            col_bits = self.column_bits(col, selected)
+            bits = col_bits if bits is None else np.bitwise_and(bits, col_bits, out=bits)
+        return bits
+
+    def select(self, filters, rows=None):
+        """Row positions matching `filters` ({column: selected values}), or None for all rows.
+
+        `rows` optionally restricts the result to those (sorted) row positions.
+        """
+        bits = self.select_bits(filters)
+        if bits is None:
+            return rows
+        changed = self.changed_rows
+        # The bits of changed rows are stale (select_bits' result is a fresh array)
+        stale = changed[changed < self.n_rows]
+        _set_bits(bits[np.newaxis], np.zeros(len(stale), dtype=np.intp), stale, False)
+        if rows is None:
+            found = np.flatnonzero(np.unpackbits(bits, count=self.n_rows))
+        else:
+            loaded = rows[rows < self.n_rows]
+            found = loaded[bits_set(bits, loaded)]
+        if not len(changed):
+            return found
+        matches = np.ones(len(changed), dtype=bool)
+        for col, selected in filters.items():
+            if col in self.values and selected:
+                matches &= self.changes[col].isin(list(selected)).to_numpy(dtype=bool)
+        matches = changed[matches]
+        if rows is not None:
+            matches = matches[contains(rows, matches)]
+        return np.insert(found, np.searchsorted(found, matches), matches)
+
+
+def bits_set(bits, rows):
+    """Mask of the `rows` whose bit is set in packed bitmap `bits` (the first row is the high bit)."""
+    return (bits[rows >> 3] >> (7 - (rows & 7))) & 1 == 1
+
+
+def contains(sorted_values, values):
+    """Mask of the `values` found in the sorted array `sorted_values`."""
+    if not len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    at = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[at] == values
+
+
+def _set_bits(bitmaps, values, rows, on):
+    """Set (or clear) bit `rows[i]` in bitmap `values[i]`; values of -1 (missing) are skipped."""
+    keep = values >= 0
+    values, rows = values[keep], np.asarray(rows)[keep]
+    masks = (0x80 >> (rows & 7)).astype(np.uint8)
+    if on:
+        np.bitwise_or.at(bitmaps, (values, rows >> 3), masks)
+    else:
+        np.bitwise_and.at(bitmaps, (values, rows >> 3), ~masks)
+
+
+def sorted_rows(values, rows, ascending=True):
+    """Row positions (`rows`, or all rows if None) ordered by `values`, the sort column at
+    those rows; missing values last."""
+    order = values.reset_index(drop=True).sort_values(ascending=ascending, kind='stable', na_position='last').index
+    order = order.to_numpy()
+    return order if rows is None else rows[order]
+
+
+def sample_rows(rows, n, seed=0):
+    """`n` of the sorted row positions `rows`, drawn at random without replacement, in row order."""
+    picks = np.random.default_rng(seed).choice(len(rows), n, replace=False)
+    return rows[np.sort(picks)]
+
+
+def page_rows(n_rows, rows, page, page_size):
+    """Row positions on `page` (0-based) of a selection; `rows` None means all rows in order."""
+    start = page * page_size
+    stop = min(start + page_size, n_rows if rows is None else len(rows))
+    if rows is None:
+        return np.arange(start, max(start, stop))
+    return rows[start:stop]
+
+
+# Latitude/Longitude are quantized to this many bits per axis for the Morton key
+MORTON_BITS = 16
+EARTH_RADIUS_KM = 6371.0
+
+
+def _spread_bits(values):
+    """Insert a zero bit between each of the low 16 bits of `values` (uint64)."""
+    values = values & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+
+def morton_keys(x, y):
+    """Z-order keys interleaving the bits of quantized x (even bits) and y (odd bits)."""
+    return _spread_bits(np.asarray(x, dtype=np.uint64)) | (_spread_bits(np.asarray(y, dtype=np.uint64)) << 1)
+
+
+def circle_bounds(lat, lon, km):
+    """(lat_min, lat_max, lon_min, lon_max) of the box around the circle of `km` kilometres around (lat, lon)."""
+    angle = km / EARTH_RADIUS_KM
+    dlat = np.degrees(angle)
+    dlon = np.degrees(np.arcsin(min(1.0, np.sin(angle) / max(np.cos(np.radians(lat)), 1e-12))))
+    if dlon >= 90:
+        dlon = 180.0  # The circle reaches over a pole
+    return float(lat - dlat), float(lat + dlat), float(lon - dlon), float(lon + dlon)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    """Rows with coordinates, sorted by the Morton (Z-order) key of Latitude/Longitude.
+
+    A bounding box is split into a few aligned Z-order blocks, each of which
+    is a contiguous key range found with a binary search, so a query only
+    touches the rows near the box instead of scanning every row.
+    """
+
+    def __init__(self, df, lat_col='Latitude', lon_col='Longitude'):
+        self.lat_col, self.lon_col = lat_col, lon_col
+        lat = df[lat_col].to_numpy(dtype=float, na_value=np.nan)
+        lon = df[lon_col].to_numpy(dtype=float, na_value=np.nan)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        rows = np.flatnonzero(valid)
+        lat, lon = lat[rows], lon[rows]
+        self.n_rows = len(df)
+        # Which rows have coordinates, one bit per row
+        self.located_bits = np.packbits(valid)
+        self.bounds = (lat.min(), lat.max(), lon.min(), lon.max()) if len(rows) else (0.0, 1.0, 0.0, 1.0)
+        keys = morton_keys(self._quantize(lon, 2), self._quantize(lat, 0))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.rows = rows[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self.changed_rows = np.empty(0, dtype=np.int64)
+        self.changed_lat = self.changed_lon = np.empty(0)
+
+    def nbytes(self):
+        return (self.keys.nbytes + self.rows.nbytes + self.lat.nbytes + self.lon.nbytes
+                + self.located_bits.nbytes + self.changed_lat.nbytes + self.changed_lon.nbytes)
+
+    def patch(self, df):
+        """Copy of the index for `df` (a SegmentedFrame), reading its changed rows' coordinates.
+
+        The sorted arrays stay those of the loaded rows. _scan() drops the
+        changed rows' entries from its results and tests their current
+        coordinates directly, so a patch costs the changed rows only.
+        """
+        patched = copy.copy(self)
+        patched.changed_rows = df.rows
+        patched.changed_lat = df.changes[self.lat_col].to_numpy(dtype=float, na_value=np.nan)
+        patched.changed_lon = df.changes[self.lon_col].to_numpy(dtype=float, na_value=np.nan)
+        return patched
+
+    def located(self, rows=None):
+        """Sorted positions of the rows with coordinates, among the sorted `rows` if given."""
+        if rows is None:
+            found = np.flatnonzero(np.unpackbits(self.located_bits, count=self.n_rows))
+        else:
+            loaded = rows[rows < self.n_rows]
+            found = loaded[bits_set(self.located_bits, loaded)]
+        if not len(self.changed_rows):
+            return found
+        # Changed rows count by their current coordinates
+        found = found[~contains(self.changed_rows, found)]
+        matches = self.changed_rows[~(np.isnan(self.changed_lat) | np.isnan(self.changed_lon))]
+        if rows is not None:
+            matches = matches[contains(rows, matches)]
+        return np.insert(found, np.searchsorted(found, matches), matches)
+
+    def _quantize(self, values, axis):
+        low, high = self.bounds[axis], self.bounds[axis + 1]
+        scale = ((1 << MORTON_BITS) - 1) / (high - low) if high > low else 0.0
+        cells = np.floor((np.asarray(values, dtype=float) - low) * scale)
+        return np.clip(cells, 0, (1 << MORTON_BITS) - 1).astype(np.int64)
+
+    def _key_ranges(self, x0, x1, y0, y1, max_ranges=64):
+        """Morton key ranges covering the quantized box [x0, x1] x [y0, y1]."""
+        ranges = []
+        # Aligned square blocks of side 2**level, refined breadth-first while the
+        # range budget allows, so all edges of the box get the same resolution
+        blocks = deque([(MORTON_BITS, 0, 0)])
+        while blocks:
+            level, bx, by = blocks.popleft()
+            side = 1 << level
+            if bx > x1 or by > y1 or bx + side - 1 < x0 or by + side - 1 < y0:
+                continue
+            inside = x0 <= bx and bx + side - 1 <= x1 and y0 <= by and by + side - 1 <= y1
+            if inside or level == 0 or len(ranges) + len(blocks) + 4 > max_ranges:
+                start = int(morton_keys(bx, by))
+                ranges.append((start, start + side * side - 1))
+            else:
+                half = side >> 1
+                blocks.extend((level - 1, bx + dx, by + dy) for dx in (0, half) for dy in (0, half))
+        return ranges
+
+    def _scan(self, lat_min, lat_max, lon_min, lon_max):
+        """Positions, Latitude and Longitude of the rows inside the box (unsorted)."""
+        x0, x1 = self._quantize([lon_min, lon_max], 2)
+        y0, y1 = self._quantize([lat_min, lat_max], 0)
+        ranges = np.array(self._key_ranges(x0, x1, y0, y1), dtype=np.uint64).reshape(-1, 2)
+        # Binary search for every range at once (keys and bounds must both be uint64)
+        starts = np.searchsorted(self.keys, ranges[:, 0], side='left')
+        stops = np.searchsorted(self.keys, ranges[:, 1], side='right')
+        rows, lats, lons = [], [], []
+        for lo, hi in zip(starts, stops):
+            if hi > lo:
+                lat, lon = self.lat[lo:hi], self.lon[lo:hi]
+                hit = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+                # Changed rows are tested below, with their current coordinates
+                hit[hit] = ~contains(self.changed_rows, self.rows[lo:hi][hit])
+                rows.append(self.rows[lo:hi][hit])
+                lats.append(lat[hit])
+                lons.append(lon[hit])
+        if len(self.changed_rows):
+            lat, lon = self.changed_lat, self.changed_lon
+            hit = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+            rows.append(self.changed_rows[hit])
+            lats.append(lat[hit])
+            lons.append(lon[hit])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        return np.concatenate(rows), np.concatenate(lats), np.concatenate(lons)
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max):
+        """Sorted row positions with lat_min <= Latitude <= lat_max and lon_min <= Longitude <= lon_max."""
+        rows, _, _ = self._scan(lat_min, lat_max, lon_min, lon_max)
+        return np.sort(rows)
+
+    def radius(self, lat, lon, km):
+        """Sorted row positions within `km` kilometres (great-circle) of (lat, lon)."""
+        # Bounding box of the circle, then the exact great-circle distance
+        rows, row_lat, row_lon = self._scan(*circle_bounds(lat, lon, km))
+        return np.sort(rows[haversine_km(lat, lon, row_lat, row_lon) <= km])
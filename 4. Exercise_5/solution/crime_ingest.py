@@ -0,0 +1,256 @@
+"""Incremental updates of the Chicago crime dashboard's data: upsert incidents by ID.
+
+The city republishes new and corrected incidents daily. apply_updates()
+merges such a batch into the loaded data without reloading it:
+
+- An incident whose ID is new is appended.
+- One whose ID is known replaces the loaded version if its `Updated On` is
+  later. An older or equal version is ignored.
+
+The loaded frame stays as it is, mapped from the snapshot. The changed
+rows live in a small segment over it (SegmentedFrame) at stable positions:
+appended at the end, or replacing a loaded row in place. New values extend
+the sorted category dictionaries. The indexes keep their loaded state and
+check the segment's rows apart, so they are patched with the segment
+alone; the aggregates are patched with just the batch (its rows and their
+replaced versions). A batch costs its own size and that of the earlier
+changes, never the history's.
+
+Every patch returns new objects and leaves the old ones untouched, so a
+rerun that is still reading the previous version sees a consistent set.
+"""
+import copy
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from crime_data import CSV_DTYPES, TEXT_DTYPE, coerce_types, epoch_seconds
+from crime_index import contains
+
+# Everything the in-memory dashboard serves, as loaded or as patched by apply_updates()
+CrimeData = namedtuple('CrimeData', ['df', 'filter_index', 'spatial_index', 'cube', 'describe_sketch',
+                                     'timeline', 'ids', 'version'], defaults=[None, 0])
+
+
+class SegmentedFrame:
+    """The loaded frame with the rows changed since the load layered over it.
+
+    The base frame (mapped read-only from the snapshot) is never copied.
+    `rows` are the sorted positions of the changed rows: replaced base rows,
+    and appended ones from len(base) on. `changes` holds their current
+    versions, indexed by position. Its dtypes are the base ones widened by
+    the updates (longer category dictionaries, missing flags), which take()
+    applies to the base rows it reads.
+    """
+
+    def __init__(self, base, rows=None, changes=None):
+        self.base = base
+        self.rows = np.empty(0, dtype=np.int64) if rows is None else rows
+        self.changes = base.iloc[:0] if changes is None else changes
+        self.n_rows = max(len(base), int(self.rows[-1]) + 1 if len(self.rows) else 0)
+        self._casts = {col: dtype for col, dtype in self.changes.dtypes.items() if dtype != base[col].dtype}
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def columns(self):
+        return self.base.columns
+
+    @property
+    def dtypes(self):
+        return self.changes.dtypes
+
+    @property
+    def attrs(self):
+        return self.base.attrs
+
+    def nbytes(self):
+        """Bytes of the changed rows (the base frame is counted separately)."""
+        return int(self.changes.memory_usage(index=False).sum()) + self.rows.nbytes
+
+    def locate(self, rows):
+        """For row positions `rows`: which are changed, and where the changed ones are in `changes`."""
+        rows = np.asarray(rows, dtype=np.int64)
+        changed = contains(self.rows, rows)
+        return changed, np.searchsorted(self.rows, rows[changed])
+
+    def pieces(self, columns=None):
+        """The whole frame as (frame, sign) pieces: the base as it is, its replaced rows
+        negated, and the changed rows. Counts and sums over the frame are the signed sums
+        of the pieces' ones, so the base is aggregated in place instead of copied."""
+        base = self.base if columns is None else self.base[columns]
+        if not len(self.rows):
+            return [(base, 1)]
+        replaced = self.rows[self.rows < len(self.base)]
+        changes = self.changes if columns is None else self.changes[columns]
+        return [(base, 1), (base.take(replaced), -1), (changes, 1)]
+
+    def take(self, rows=None, columns=None):
+        """Rows at positions `rows` (all rows if None), only `columns` if given, indexed by position.
+
+        Once rows have changed, all rows means a copy of the frame: aggregate
+        the pieces() instead where the result is a count or sum.
+        """
+        base = self.base if columns is None else self.base[columns]
+        if not len(self.rows):
+            return base if rows is None else base.take(rows)
+        rows = np.arange(self.n_rows) if rows is None else np.asarray(rows, dtype=np.int64)
+        changed, at = self.locate(rows)
+        unchanged = base.take(rows[~changed])
+        unchanged = unchanged.astype({col: dtype for col, dtype in self._casts.items() if col in unchanged.columns})
+        changes = self.changes if columns is None else self.changes[columns]
+        # Interleave the two parts back into the order of `rows`
+        order = np.empty(len(rows), dtype=np.intp)
+        order[~changed] = np.arange(len(unchanged))
+        order[changed] = len(unchanged) + np.arange(len(at))
+        result = pd.concat([unchanged, changes.take(at)]).take(order)
+        result.index = rows
+        return result
+
+
+class IdIndex:
+    """Row position of every incident ID: the loaded IDs through a sorting permutation, then the added ones.
+
+    The loaded IDs are the base frame's own column; only the permutation
+    (4 bytes per row) is built. IDs appended by updates are kept sorted
+    apart, so a patch costs the batch, not the history.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.order = np.argsort(ids, kind='stable').astype(np.int32 if len(ids) < 2**31 else np.int64)
+        self.added_ids = np.empty(0, dtype=np.int64)
+        self.added_rows = np.empty(0, dtype=np.int64)
+
+    def nbytes(self):
+        return self.order.nbytes + self.added_ids.nbytes + self.added_rows.nbytes
+
+    def lookup(self, ids):
+        """Row of each of `ids`, -1 where the ID is unknown."""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if len(self.ids):
+            # Search in the loaded IDs' own dtype, so they are not converted on every lookup
+            limits = np.iinfo(self.ids.dtype)
+            fits = np.flatnonzero((ids >= limits.min) & (ids <= limits.max))
+            values = ids[fits].astype(self.ids.dtype)
+            at = np.minimum(np.searchsorted(self.ids, values, sorter=self.order), len(self.ids) - 1)
+            found = self.ids[self.order[at]] == values
+            rows[fits[found]] = self.order[at[found]]
+        if len(self.added_ids):
+            found = contains(self.added_ids, ids)
+            rows[found] = self.added_rows[np.searchsorted(self.added_ids, ids[found])]
+        return rows
+
+    def patch(self, ids, rows):
+        """Copy of the index with the (new) `ids` at `rows` added."""
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        at = np.searchsorted(self.added_ids, ids[order])
+        patched = copy.copy(self)
+        patched.added_ids = np.insert(self.added_ids, at, ids[order])
+        patched.added_rows = np.insert(self.added_rows, at, np.asarray(rows)[order])
+        return patched
+
+
+def read_updates(source):
+    """Typed frame of a CSV (a path or file object) of new and updated incidents."""
+    updates = pd.read_csv(source, dtype=TEXT_DTYPE)
+    missing = [col for col in ['ID', 'Updated On'] if col not in updates.columns]
+    if missing:
+        raise ValueError(f"Updates need the columns {missing} to be matched and versioned")
+    for col, dtype in CSV_DTYPES.items():
+        if col in updates.columns:
+            updates[col] = pd.to_numeric(updates[col], errors='coerce').astype(dtype)
+    return coerce_types(updates, categories=False)
+
+
+def latest_versions(updates):
+    """One row per ID: the version with the latest Updated On (the last one on ties)."""
+    order = np.argsort(epoch_seconds(updates['Updated On']), kind='stable')
+    return updates.take(order).drop_duplicates('ID', keep='last')
+
+
+def merge_changes(frame, updates, ids):
+    """Upsert `updates` into the changed rows of `frame` (a SegmentedFrame) by ID.
+
+    Returns the new frame, the positions of the rows this batch changed (the
+    replaced ones first, then the appended ones), the versions they replaced
+    (indexed by position), and the number of updates that lost to the
+    current version. The work is proportional to the batch and the earlier
+    changes, never to the base frame.
+    """
+    updates = latest_versions(updates)
+    updates = updates.reindex(columns=frame.columns)
+    positions = ids.lookup(updates['ID'].to_numpy(dtype=np.int64))
+    known = positions >= 0
+    newer = np.ones(len(updates), dtype=bool)
+    if known.any():
+        current = frame.take(positions[known], ['Updated On'])['Updated On']
+        newer[known] = epoch_seconds(updates['Updated On'][known]) > epoch_seconds(current)
+    replaced = positions[known & newer]
+    keep = newer | ~known
+    is_new = ~known[keep]
+
+    # New values extend the dictionaries, which stay sorted (codes are only remapped then)
+    updates = updates[keep].copy()
+    dtypes = dict(frame.dtypes)
+    for col, dtype in dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            new_values = pd.Index(updates[col].dropna().unique()).difference(dtype.categories)
+            if len(new_values):
+                dtypes[col] = pd.CategoricalDtype(dtype.categories.append(new_values).sort_values(), dtype.ordered)
+        elif not _castable(updates[col], dtype):
+            dtypes[col] = updates[col].dtype
+    updates = updates.astype(dtypes)
+    added, replacements = updates[is_new], updates[~is_new]
+
+    rows = np.concatenate([replaced, np.arange(len(frame), len(frame) + len(added))])
+    batch = pd.concat([replacements, added])
+    batch.index = rows
+    before = frame.take(replaced).astype(dtypes)
+    # A row changed again keeps only its latest version
+    earlier = frame.changes.astype(dtypes)
+    earlier = earlier[~np.isin(frame.rows, replaced)]
+    changes = pd.concat([earlier, batch]).sort_index()
+    merged = SegmentedFrame(frame.base, changes.index.to_numpy(dtype=np.int64), changes)
+    return merged, rows, before, int((known & ~newer).sum())
+
+
+def _castable(series, dtype):
+    """True if `series` converts to `dtype` without losing values (e.g. missing flags into bool)."""
+    return not (dtype == bool and series.isna().any())
+
+
+def apply_updates(data, updates):
+    """Upsert a typed frame of incidents (see read_updates) into `data` (a CrimeData).
+
+    Returns the patched CrimeData, or `data` itself if nothing changed, and
+    a report: rows received, added, replaced, ignored as stale, and seconds.
+    """
+    start = time.perf_counter()
+    frame = data.df if isinstance(data.df, SegmentedFrame) else SegmentedFrame(data.df)
+    ids = data.ids if data.ids is not None else IdIndex(frame.base['ID'].to_numpy())
+    df, rows, before, stale = merge_changes(frame, updates, ids)
+    n_added = len(rows) - len(before)
+    report = {'received': len(updates), 'added': n_added, 'replaced': len(before), 'stale': stale}
+    if len(rows):
+        data = CrimeData(
+            df=df,
+            filter_index=data.filter_index.patch(df),
+            spatial_index=data.spatial_index.patch(df),
+            cube=data.cube.patch(df, rows, before),
+            describe_sketch=data.describe_sketch.patch(df, rows, before),
+            timeline=data.timeline.patch(df, rows, before) if data.timeline is not None else None,
+            ids=ids.patch(df.changes['ID'].loc[rows[len(before):]].to_numpy(dtype=np.int64), rows[len(before):]),
+            version=data.version + 1,
+        )
+    else:
+        data = data._replace(df=frame, ids=ids)
+    report['rows'] = len(data.df)
+    report['changed_rows'] = len(data.df.rows)
+    report['seconds'] = time.perf_counter() - start
+    return data, report
@@ -0,0 +1,138 @@
+"""Runtime measurements for the Chicago crime dashboard."""
+import functools
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Latest durations kept per stage for the latency percentiles
+STAGE_SAMPLES = int(os.environ.get('CRIME_STAGE_SAMPLES', 2048))
+STAGE_QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+def process_memory():
+    """(current RSS, peak RSS) of this process in bytes; current is None if unknown."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS
+    if sys.platform != 'darwin':
+        peak *= 1024
+    current = None
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+    return current, peak
+
+
+def mapped_memory():
+    """(private, file/shared-memory backed) resident bytes of this process, or None if unknown.
+
+    Pages of a memory-mapped snapshot are file-backed: every process mapping
+    the same file shares them, so they are not multiplied by the process count.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            fields = dict(line.split(':', 1) for line in smaps if ':' in line)
+    except OSError:
+        return None
+    rss = int(fields['Rss'].split()[0]) * 1024
+    anonymous = int(fields['Anonymous'].split()[0]) * 1024
+    return anonymous, rss - anonymous
+
+
+def format_bytes(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(n) < 1024 or unit == 'GiB':
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{int(n)} B"
+        n /= 1024
+
+
+def arrow_payload(df):
+    """(bytes, seconds) to serialize `df` to Arrow IPC, as st.dataframe does."""
+    start = time.perf_counter()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    size = sink.getvalue().size
+    return size, time.perf_counter() - start
+
+
+class StageTimings:
+    """Durations of the dashboard's rerun stages (load, filter, metrics, ...) across sessions.
+
+    Each stage keeps its latest `samples` durations in a ring buffer, for
+    p50/p95/p99 over recent reruns, plus an all-time count and sum. Stages
+    are recorded from the script thread and the query workers alike.
+    """
+
+    def __init__(self, samples=STAGE_SAMPLES):
+        self.samples = samples
+        self._recent = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if stage not in self._recent:
+                self._recent[stage] = deque(maxlen=self.samples)
+                self._totals[stage] = [0, 0.0]
+            self._recent[stage].append(seconds)
+            self._totals[stage][0] += 1
+            self._totals[stage][1] += seconds
+
+    def reset(self):
+        """Forget every recorded duration."""
+        with self._lock:
+            self._recent.clear()
+            self._totals.clear()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed(self, stage, fn):
+        """`fn`, recording the duration of every call under `stage`."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def summary(self):
+        """Per stage: recent samples, their p50/p95/p99 and max in seconds, all-time count and sum."""
+        with self._lock:
+            recent = {stage: np.array(durations) for stage, durations in self._recent.items()}
+            totals = {stage: tuple(total) for stage, total in self._totals.items()}
+        rows = []
+        for stage, durations in recent.items():
+            quantiles = np.quantile(durations, list(STAGE_QUANTILES.values()))
+            rows.append({'stage': stage, 'samples': len(durations), **dict(zip(STAGE_QUANTILES, quantiles)),
+                         'max': durations.max(), 'count': totals[stage][0], 'sum': totals[stage][1]})
+        columns = ['stage', 'samples', *STAGE_QUANTILES, 'max', 'count', 'sum']
+        return pd.DataFrame(rows, columns=columns).set_index('stage')
+
+    def prometheus(self, name='crime_dashboard_stage_seconds'):
+        """The timings in the Prometheus text format: one summary (quantiles, _sum, _count) per stage."""
+        lines = [f"# HELP {name} Duration of the dashboard's rerun stages; quantiles over the "
+                 f"last {self.samples} reruns of each stage.",
+                 f"# TYPE {name} summary"]
+        for stage, row in self.summary().iterrows():
+            label = stage.replace('\\', '\\\\').replace('"', '\\"')
+            for column, q in STAGE_QUANTILES.items():
+                lines.append(f'{name}{{stage="{label}",quantile="{q}"}} {row[column]:.6f}')
+            lines.append(f'{name}_sum{{stage="{label}"}} {row["sum"]:.6f}')
+            lines.append(f'{name}_count{{stage="{label}"}} {int(row["count"])}')
+        return '\n'.join(lines) + '\n'
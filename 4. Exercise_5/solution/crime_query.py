@@ -0,0 +1,158 @@
+"""Query backends for the Chicago crime dashboard: run aggregations inline or in a worker pool.
+
+A script run collects its queries in a QueryBatch. Each query's result is
+rendered into a container the script reserved for it, in the order the
+queries complete, so fast results (the metric cards) appear before slow
+ones (charts, maps). Inline (sync), a query has completed by the time the
+script reserves its container, so it renders right there. A failed query
+shows its error in its own container; the others still render. A newer
+run of the same session cancels the queries of the older one that have
+not started yet.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+QUERY_BACKENDS = ['sync', 'threads']
+DEFAULT_QUERY_WORKERS = int(os.environ.get('CRIME_QUERY_WORKERS', min(4, os.cpu_count() or 1)))
+
+
+class QueryBatch:
+    """The queries of one script run and the containers their results render into."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.futures = []
+        self.renders = []
+
+    def submit(self, fn, *args):
+        future = self.backend.submit(fn, *args)
+        self.futures.append(future)
+        return future
+
+    def render_later(self, slot, future, render):
+        """Call render(result) inside container `slot` once `future` completes (see flush).
+
+        A query that has already completed (always, on the sync backend) renders now.
+        """
+        if future.done():
+            self._render(future, slot, render)
+        else:
+            self.renders.append((future, slot, render))
+
+    @staticmethod
+    def _render(future, slot, render):
+        with slot:
+            try:
+                render(future.result())
+            except Exception as error:
+                slot.exception(error)
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def cancel(self):
+        """Cancel the queries that have not started; running ones finish and are ignored."""
+        for future in self.futures:
+            future.cancel()
+
+    def flush(self, status=None, poll=0.1):
+        """Render each deferred result as soon as its query completes, fastest first.
+
+        `status` (an st.empty) shows progress while waiting. Updating it also
+        lets Streamlit stop this run when a newer one is requested; whatever
+        is still pending then is cancelled on the way out.
+        """
+        remaining = list(self.renders)
+        start = time.perf_counter()
+        try:
+            while remaining:
+                done, _ = wait([future for future, _, _ in remaining], timeout=poll, return_when=FIRST_COMPLETED)
+                for item in [item for item in remaining if item[0] in done]:
+                    self._render(*item)
+                    remaining.remove(item)
+                if remaining and status is not None:
+                    status.caption(f"⏳ {len(remaining)} queries running ({time.perf_counter() - start:.1f} s)")
+        finally:
+            self.cancel()
+            self.renders = []
+            if status is not None:
+                status.empty()
+
+
+class Lazy:
+    """fn() computed by the first caller, in whichever thread, and shared with the later ones."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._result = None
+        self._done = False
+
+    def __call__(self):
+        with self._lock:
+            if not self._done:
+                self._result = self.fn()
+                self._done = True
+        return self._result
+
+    def done(self):
+        return self._done
+
+
+class SyncBackend:
+    """Runs every query inline, in the script thread, as the dashboard always has."""
+
+    name = 'sync'
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def start_batch(self, session):
+        return QueryBatch(self)
+
+
+class PoolBackend(SyncBackend):
+    """Runs queries in a thread pool shared by every session.
+
+    Threads share the cached frame, indexes and rollups without copying, and
+    numpy/pandas release the GIL in their kernels, so queries overlap.
+    """
+
+    name = 'threads'
+
+    def __init__(self, workers=DEFAULT_QUERY_WORKERS):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crime-query')
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def start_batch(self, session):
+        """A new batch for `session`; its previous batch is stale and gets cancelled."""
+        batch = QueryBatch(self)
+        with self._lock:
+            # Batches of sessions that have gone away are dropped once they finish
+            for key in [key for key, old in self._batches.items() if old.done()]:
+                del self._batches[key]
+            previous = self._batches.get(session)
+            self._batches[session] = batch
+        if previous is not None:
+            previous.cancel()
+        return batch
+
+
+def make_backend(name, workers=DEFAULT_QUERY_WORKERS):
+    if name == 'sync':
+        return SyncBackend()
+    if name == 'threads':
+        return PoolBackend(workers)
+    raise ValueError(f"Unknown query backend {name!r}; use one of {QUERY_BACKENDS}")
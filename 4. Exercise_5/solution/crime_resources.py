@@ -0,0 +1,204 @@
+"""Process-wide resources of the Chicago crime dashboard, and their prewarm.
+
+The dataset, its indexes and aggregates are st.cache_resource values shared
+by every session. start_prewarm() builds them all in a background thread,
+so the first visitor does not pay the parse; readiness() reports progress.
+ingest_updates() upserts new and updated incidents into them without a
+reload (crime_ingest.py); current_data() is what a rerun serves.
+"""
+import os
+import threading
+import time
+
+import streamlit as st
+
+from crime_aggregates import AggregateCache, CrimeCube, DescribeSketch, TimeRollup
+from crime_data import load_crime_data, SHARED_DIR
+from crime_index import FilterIndex, SpatialIndex
+from crime_ingest import CrimeData, IdIndex, SegmentedFrame, apply_updates, read_updates
+from crime_profiling import StageTimings
+from crime_query import make_backend
+from crime_sql import DEFAULT_SQL_ENGINE, open_database
+
+# Dataset: a CSV file, or a directory of CSV shards (e.g. one per year) parsed in parallel
+DATA_PATH = os.environ.get('CRIME_DATA_PATH', 'dataset.csv')
+# Where the typed snapshot lives: 'local' in .crime_cache/ next to the data, or
+# 'shared' in SHARED_DIR (tmpfs), held in RAM once for every process on the host
+CACHE_MODE = os.environ.get('CRIME_CACHE_MODE', 'local')
+# Layout of the in-memory frame: 'full' (as parsed), or 'compact' (dictionary-encoded text,
+# small nullable ints, float32 coordinates, no Location; see crime_data.COMPACT_DTYPES)
+SCHEMA = os.environ.get('CRIME_SCHEMA', 'full')
+# How the dashboard runs its queries: 'sync' in the script thread, or 'threads' in a worker pool
+QUERY_BACKEND = os.environ.get('CRIME_QUERY_BACKEND', 'sync')
+# Where the rows live: 'memory' (the mapped snapshot, indexes and aggregates below), or
+# 'sql' (an on-disk database that answers every view with aggregate queries; crime_sql.py)
+DATA_ENGINE = os.environ.get('CRIME_DATA_ENGINE', 'memory')
+# Embedded engine of the 'sql' mode: 'duckdb' if installed, else 'sqlite'
+SQL_ENGINE = os.environ.get('CRIME_SQL_ENGINE', DEFAULT_SQL_ENGINE)
+# Show the stage latency (admin) tab in the dashboard
+ADMIN_TAB = os.environ.get('CRIME_ADMIN_TAB', '0') == '1'
+
+
+# Load the dataset (parsed once, then mapped read-only from the typed snapshot).
+# cache_resource hands every rerun the same frame; cache_data would copy it each time.
+@st.cache_resource(show_spinner=False)
+def load_data():
+    return load_crime_data(DATA_PATH, folder=SHARED_DIR if CACHE_MODE == 'shared' else None,
+                           compact=SCHEMA == 'compact')
+
+
+# Bitmap/code index over the filter columns, built once per dataset
+@st.cache_resource(show_spinner=False)
+def load_filter_index():
+    return FilterIndex(load_data())
+
+
+# Morton-ordered Latitude/Longitude index for area queries, built once per dataset
+@st.cache_resource(show_spinner=False)
+def load_spatial_index():
+    return SpatialIndex(load_data())
+
+
+# Count/arrest cube over the low-cardinality columns, built once per dataset
+@st.cache_resource(show_spinner=False)
+def load_cube():
+    return CrimeCube(load_data())
+
+
+# Per-(Year, Primary Type) statistics sketches for the Dataset Statistics panel
+@st.cache_resource(show_spinner=False)
+def load_describe_sketch():
+    return DescribeSketch(load_data())
+
+
+# Hour x crime type counts over Date for the time-series views; None without a Date column
+@st.cache_resource(show_spinner=False)
+def load_timeline():
+    df = load_data()
+    return TimeRollup(df) if 'Date' in df.columns else None
+
+
+# Row position of every incident ID, for matching incremental updates
+@st.cache_resource(show_spinner=False)
+def load_id_index():
+    return IdIndex(load_data()['ID'].to_numpy())
+
+
+# On-disk SQL database of the dataset (built once), for CRIME_DATA_ENGINE=sql
+@st.cache_resource(show_spinner=False)
+def load_database():
+    return open_database(DATA_PATH, SQL_ENGINE, folder=SHARED_DIR if CACHE_MODE == 'shared' else None)
+
+
+# Aggregates per filter combination, shared by all sessions (LRU, bounded memory)
+@st.cache_resource(show_spinner=False)
+def load_aggregate_cache():
+    return AggregateCache()
+
+
+# Query backend (and its worker pool) shared by all sessions
+@st.cache_resource(show_spinner=False)
+def load_query_backend():
+    return make_backend(QUERY_BACKEND)
+
+
+# Latency of every session's rerun stages, for the admin tab and serve.py's /metrics
+@st.cache_resource(show_spinner=False)
+def load_stage_timings():
+    return StageTimings()
+
+
+# Everything a dashboard rerun needs, in build order
+if DATA_ENGINE == 'sql':
+    RESOURCES = [
+        ('database', load_database),
+        ('aggregate cache', load_aggregate_cache),
+        ('query backend', load_query_backend),
+    ]
+else:
+    RESOURCES = [
+        ('dataset', load_data),
+        ('filter index', load_filter_index),
+        ('spatial index', load_spatial_index),
+        ('aggregate cube', load_cube),
+        ('statistics sketches', load_describe_sketch),
+        ('time rollups', load_timeline),
+        ('ID index', load_id_index),
+        ('aggregate cache', load_aggregate_cache),
+        ('query backend', load_query_backend),
+    ]
+
+# The data as patched by the latest incremental update; None while the loaded data is current
+_updated = {'data': None}
+_update_lock = threading.Lock()
+
+
+def current_data():
+    """The frame, indexes and aggregates a rerun serves (a CrimeData), updates included."""
+    data = _updated['data']
+    if data is None:
+        data = CrimeData(SegmentedFrame(load_data()), load_filter_index(), load_spatial_index(), load_cube(),
+                         load_describe_sketch(), load_timeline(), load_id_index())
+    return data
+
+
+def ingest_updates(source):
+    """Upsert a CSV (a path or file object) of new and updated incidents; apply_updates()' report.
+
+    Sessions serve the patched data from their next rerun on. The updates
+    live in this process only, layered over the mapped snapshot: the CSV and
+    its snapshot are left as they are.
+    """
+    if DATA_ENGINE == 'sql':
+        raise RuntimeError("Incremental updates patch the in-memory data; not available with CRIME_DATA_ENGINE=sql")
+    updates = read_updates(source)
+    with _update_lock:
+        data, report = apply_updates(current_data(), updates)
+        _updated['data'] = data
+    # Aggregates cached for the previous version are keyed by it; free them now
+    load_aggregate_cache().clear()
+    return report
+
+
+_done = threading.Event()
+_lock = threading.Lock()
+_state = {'started': None, 'stage': None, 'seconds': {}, 'error': None}
+
+
+def _prewarm():
+    try:
+        for stage, load in RESOURCES:
+            _state['stage'] = stage
+            start = time.perf_counter()
+            load()
+            _state['seconds'][stage] = time.perf_counter() - start
+        _state['stage'] = None
+    except Exception as error:
+        # The process stays not-ready; a session will hit (and show) the same error
+        _state['error'] = f"{type(error).__name__}: {error}"
+    finally:
+        _done.set()
+
+
+def start_prewarm():
+    """Build every resource in a background thread, once per process."""
+    with _lock:
+        if _state['started'] is None:
+            _state['started'] = time.time()
+            threading.Thread(target=_prewarm, name='crime-prewarm', daemon=True).start()
+
+
+def wait_ready(timeout=None):
+    """Block until the prewarm has finished (or failed); True once every resource is built."""
+    _done.wait(timeout)
+    return is_ready()
+
+
+def is_ready():
+    return _done.is_set() and _state['error'] is None
+
+
+def readiness():
+    """Snapshot of the prewarm: ready flag, current stage, per-stage seconds, error."""
+    return {'ready': is_ready(), 'stage': _state['stage'], 'error': _state['error'],
+            'seconds': dict(_state['seconds'])}
@@ -0,0 +1,459 @@
+"""Embedded SQL engine for the Chicago crime dashboard: DuckDB if installed, else SQLite.
+
+The dataset is streamed into an on-disk database next to the CSV once (see
+open_database()). The sidebar filters become a WHERE clause and every metric,
+chart and map layer a GROUP BY, so only aggregates and the visible preview
+page come back to Python: the rows are served from disk and never have to
+fit in memory.
+"""
+import math
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from urllib.request import pathname2url
+
+import numpy as np
+import pandas as pd
+
+from crime_aggregates import (DESCRIBE_DATES, DESCRIBE_STATS, MAP_MAX_CELLS, MISSING_CATEGORY, RATE_FLAGS,
+                              describe_dates, fill_buckets, grid_cell_size, merge_grid, python_scalar, top_columns)
+from crime_data import (BOOL_COLUMNS, CATEGORY_COLUMNS, CHUNK_ROWS, CSV_DTYPES, DATE_COLUMNS, DROP_COLUMNS,
+                        coerce_types, csv_dtypes, epoch_seconds, find_shards, publish_snapshot, snapshot_path)
+from crime_index import EARTH_RADIUS_KM, circle_bounds
+
+try:
+    import duckdb
+except ImportError:  # Optional: SQLite (standard library) answers the same queries, more slowly
+    duckdb = None
+
+SQL_ENGINES = ['duckdb', 'sqlite']
+DEFAULT_SQL_ENGINE = 'duckdb' if duckdb is not None else 'sqlite'
+# Bump when the table layout changes so old databases are not rebuilt into
+SQL_VERSION = 1
+TABLE = 'crimes'
+# SQLite indexes: the filter columns, and Latitude for the area's bounding box
+SQLITE_INDEXES = CATEGORY_COLUMNS + ['Latitude']
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_chunks(path, chunksize=CHUNK_ROWS):
+    """Typed chunks of a crime CSV (or directory of CSV shards), with timestamps as epoch seconds.
+
+    Only one chunk is in memory at a time. SQLite has no timestamp type, so
+    both engines store Date and Updated On as integer seconds since the epoch.
+    """
+    paths = find_shards(path) if os.path.isdir(path) else [path]
+    if not paths:
+        raise FileNotFoundError(f"No CSV shards in {path}")
+    columns, dtypes = csv_dtypes(paths[0], drop=DROP_COLUMNS)
+    for part in paths:
+        for chunk in pd.read_csv(part, usecols=columns, dtype=dtypes, chunksize=chunksize):
+            chunk = coerce_types(chunk[columns], categories=False)
+            for col in DATE_COLUMNS:
+                if col in chunk.columns:
+                    missing = chunk[col].isna().to_numpy()
+                    chunk[col] = pd.arrays.IntegerArray(epoch_seconds(chunk[col]), missing)
+            yield chunk
+
+
+def from_sql_types(df, categories=None):
+    """Restore the in-memory frame's column types on rows read back from the database.
+
+    Timestamps and bools come back as integers, and the CSV_DTYPES ints as
+    floats where a value is missing; `categories` maps the category columns
+    to their sorted values. A page then renders as it does in memory.
+    """
+    for col, dtype in CSV_DTYPES.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+    for col, values in (categories or {}).items():
+        if col in df.columns:
+            df[col] = pd.Categorical(df[col], categories=values, ordered=True)
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], unit='s').astype('datetime64[s]')
+    for col in BOOL_COLUMNS:
+        if col in df.columns:
+            # SQLite returns 0/1
+            values = df[col].astype('boolean')
+            df[col] = values if values.isna().any() else values.astype(bool)
+    return df
+
+
+class CrimeDatabase(ABC):
+    """Read-only aggregate queries over the crimes table of one database file.
+
+    Every query takes the sidebar selection as `filters` ({column: selected
+    values}) and an optional `area` (latitude, longitude, radius in km) and
+    returns pandas objects shaped like the in-memory aggregates' (CrimeCube,
+    TimeRollup, DescribeSketch, spatial_grid). Each thread gets its own
+    connection, so the query backend's workers can run queries side by side.
+    The engine-specific SQL lives in the subclasses.
+    """
+
+    engine = None
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.columns = [column[0] for column in self._execute(f'SELECT * FROM {TABLE} LIMIT 0').description]
+        self.n_rows = self._execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0]
+        # Sorted filter options, like the in-memory frame's ordered categories
+        self.values = {}
+        for col in CATEGORY_COLUMNS:
+            if col in self.columns:
+                rows = self._execute(f'SELECT DISTINCT {quote(col)} FROM {TABLE} WHERE {quote(col)} IS NOT NULL '
+                                     f'ORDER BY 1').fetchall()
+                self.values[col] = [value for value, in rows]
+        # The columns describe() covers: the numeric ones, Year included, and Date as its epoch seconds
+        # (as crime_aggregates.describe_columns)
+        self.numeric_columns = [col for col in self.columns if col in CSV_DTYPES or col in DESCRIBE_DATES]
+
+    def nbytes(self):
+        return os.path.getsize(self.path)
+
+    @abstractmethod
+    def connect(self):
+        """A new connection to the database file, for the calling thread."""
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self.connect()
+        return connection
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, list(params))
+
+    def _frame(self, sql, params=()):
+        cursor = self._execute(sql, params)
+        return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+    # Engine-specific expressions over integer epoch seconds
+    @abstractmethod
+    def div(self, expression, divisor):
+        """Integer (floor) division of a non-negative integer expression."""
+
+    @abstractmethod
+    def year_month(self, expression):
+        """SQL for (year, month) of epoch seconds."""
+
+    def where(self, filters, area=None, *conditions):
+        """(WHERE clause, parameters) for the selection, ANDed with the SQL `conditions`."""
+        clauses, params = list(conditions), []
+        for col, selected in filters.items():
+            if col in self.columns and len(selected):
+                clauses.append(f"{quote(col)} IN ({', '.join('?' * len(selected))})")
+                params.extend(python_scalar(value) for value in selected)
+        if area is not None:
+            lat, lon, km = area
+            # The circle's bounding box (indexed) first, then the exact great-circle
+            # distance, both as in SpatialIndex.radius
+            clauses.append('"Latitude" BETWEEN ? AND ? AND "Longitude" BETWEEN ? AND ?')
+            params.extend(circle_bounds(lat, lon, km))
+            clauses.append(f'2 * {EARTH_RADIUS_KM} * asin(sqrt('
+                           f'power(sin((radians("Latitude") - radians(?)) / 2), 2) + '
+                           f'cos(radians(?)) * cos(radians("Latitude")) * '
+                           f'power(sin((radians("Longitude") - radians(?)) / 2), 2))) <= ?')
+            params.extend([lat, lat, lon, km])
+        return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def count(self, filters, area=None, located=False):
+        """Rows of the selection (only those with coordinates if `located`)."""
+        located = ['"Latitude" IS NOT NULL', '"Longitude" IS NOT NULL'] if located else []
+        clause, params = self.where(filters, area, *located)
+        return self._execute(f'SELECT COUNT(*) FROM {TABLE} {clause}', params).fetchone()[0]
+
+    def metrics(self, filters, area=None):
+        """Values for the dashboard's metric cards, as CrimeCube.metrics()."""
+        clause, params = self.where(filters, area)
+        has_arrest, has_type, has_year = (col in self.columns for col in ['Arrest', 'Primary Type', 'Year'])
+        row = self._execute(
+            f'SELECT COUNT(*), '
+            f'{"SUM(CAST(" + quote("Arrest") + " AS INTEGER))" if has_arrest else "NULL"}, '
+            f'{"COUNT(DISTINCT " + quote("Primary Type") + ")" if has_type else "NULL"}, '
+            f'{"MIN(" + quote("Year") + "), MAX(" + quote("Year") + ")" if has_year else "NULL, NULL"} '
+            f'FROM {TABLE} {clause}', params).fetchone()
+        total, arrests, crime_types, year_min, year_max = row
+        return {'total': int(total), 'arrests': int(arrests or 0) if has_arrest else None,
+                'crime_types': int(crime_types) if has_type else None, 'year_min': year_min, 'year_max': year_max}
+
+    def rollup(self, filters, by, area=None):
+        """count (and arrests) per value of `by`, as CrimeCube.rollup()."""
+        clause, params = self.where(filters, area, f'{quote(by)} IS NOT NULL')
+        arrests = ', SUM(CAST("Arrest" AS INTEGER)) AS arrests' if 'Arrest' in self.columns else ''
+        frame = self._frame(f'SELECT {quote(by)}, COUNT(*) AS count{arrests} FROM {TABLE} {clause} '
+                            f'GROUP BY 1 ORDER BY 1', params)
+        return frame.set_index(by)
+
+    def counts(self, filters, by, area=None):
+        return self.rollup(filters, by, area)['count']
+
+    def arrest_rates(self, filters, by, area=None):
+        """Arrest rate (%) per value of `by`."""
+        totals = self.rollup(filters, by, area)
+        return totals['arrests'] / totals['count'] * 100
+
+    def flag_rates(self, filters, by, area=None, flags=RATE_FLAGS):
+        """Incidents and percentage of rows with each flag set per value of `by`, as flag_rates()."""
+        flags = [flag for flag in flags if flag in self.columns]
+        clause, params = self.where(filters, area, f'{quote(by)} IS NOT NULL')
+        rates = ''.join(f', 100.0 * SUM(CAST({quote(flag)} AS INTEGER)) / COUNT({quote(flag)}) AS {quote(flag)}'
+                        for flag in flags)
+        frame = self._frame(f'SELECT {quote(by)}, COUNT(*) AS "Incidents"{rates} FROM {TABLE} {clause} '
+                            f'GROUP BY 1 ORDER BY 1', params)
+        return frame.set_index(by).astype({flag: float for flag in flags})
+
+    def _bucket(self, grain):
+        """SQL key of the `grain` bucket of Date, and a function from keys to bucket starts."""
+        date = quote('Date')
+        if grain == 'hour':
+            return self.div(date, 3600), lambda keys: keys.astype('datetime64[h]')
+        if grain == 'day':
+            return self.div(date, 86400), lambda keys: keys.astype('datetime64[D]')
+        if grain == 'week':
+            # The epoch (1970-01-01) was a Thursday: weeks counted from Monday 1969-12-29
+            return self.div(f'{self.div(date, 86400)} + 3', 7), lambda keys: (keys * 7 - 3).astype('datetime64[D]')
+        year, month = self.year_month(date)
+        if grain == 'month':
+            return f'{year} * 12 + {month} - 1', lambda keys: (keys - 1970 * 12).astype('datetime64[M]')
+        if grain == 'year':
+            return year, lambda keys: (keys - 1970).astype('datetime64[Y]')
+        raise ValueError(f"Unknown time grain {grain!r}")
+
+    def time_counts(self, filters, grain='day', area=None, by_category=False, window=None):
+        """Incidents per `grain` bucket of Date, as TimeRollup.counts()."""
+        key, to_starts = self._bucket(grain)
+        clause, params = self.where(filters, area, '"Date" IS NOT NULL')
+        if not by_category:
+            frame = self._frame(f'SELECT {key} AS bucket, COUNT(*) AS n FROM {TABLE} {clause} GROUP BY 1 ORDER BY 1',
+                                params)
+            starts = to_starts(frame['bucket'].to_numpy(dtype=np.int64)).astype('datetime64[ns]')
+            return fill_buckets(starts, frame['n'].to_numpy(dtype=np.int64), grain, window=window)
+        category = quote('Primary Type') if 'Primary Type' in self.columns else 'NULL'
+        frame = self._frame(f'SELECT {key} AS bucket, {category} AS category, COUNT(*) AS n FROM {TABLE} {clause} '
+                            f'GROUP BY 1, 2', params)
+        frame['category'] = frame['category'].fillna(MISSING_CATEGORY)
+        table = frame.pivot_table(index='bucket', columns='category', values='n', aggfunc='sum', fill_value=0)
+        # Categories in sorted order with the missing ones last, as TimeRollup's columns
+        columns = sorted(col for col in table.columns if col != MISSING_CATEGORY)
+        table = table.reindex(columns=columns + [MISSING_CATEGORY] * (MISSING_CATEGORY in table.columns))
+        starts = to_starts(table.index.to_numpy(dtype=np.int64)).astype('datetime64[ns]')
+        return fill_buckets(starts, table.to_numpy(dtype=np.int64), grain, list(table.columns), window)
+
+    def top_categories(self, filters, grain='day', area=None, n=5, window=None):
+        """time_counts() by crime type, the `n` largest kept and the rest summed as 'Other'."""
+        return top_columns(self.time_counts(filters, grain, area, by_category=True), n, window)
+
+    def profile(self, filters, by='hour', area=None):
+        """Incidents per hour of the day (0-23), or per day of the week (0 = Monday) for by='weekday'."""
+        date = quote('Date')
+        slot, size = ((f'{self.div(date, 3600)} % 24', 24) if by == 'hour'
+                      else (f'({self.div(date, 86400)} + 3) % 7', 7))
+        clause, params = self.where(filters, area, f'{date} IS NOT NULL')
+        frame = self._frame(f'SELECT {slot} AS slot, COUNT(*) AS n FROM {TABLE} {clause} GROUP BY 1', params)
+        counts = frame.set_index('slot')['n'].reindex(range(size), fill_value=0)
+        return counts.rename_axis(None).rename(None).astype(np.int64)
+
+    def describe(self, filters, area=None):
+        """describe() of the numeric columns and Date for the selection, exact.
+
+        Counts, means, extremes and the squared deviations are two scans;
+        each column's quartiles take one sort (SQLite has no quantile aggregate).
+        """
+        clause, params = self.where(filters, area)
+        columns = self.numeric_columns
+        moments = ', '.join(f'COUNT({quote(col)}), AVG({quote(col)}), MIN({quote(col)}), MAX({quote(col)})'
+                            for col in columns)
+        row = np.array(self._execute(f'SELECT {moments} FROM {TABLE} {clause}', params).fetchone(),
+                       dtype=float).reshape(len(columns), 4)
+        count, mean, low, high = row.T
+        # Deviations from the mean, not sums of squares, so the variance does not cancel out
+        deviations = ', '.join(f'SUM(({quote(col)} - ?) * ({quote(col)} - ?))' for col in columns)
+        centers = [0.0 if np.isnan(value) else float(value) for value in mean for _ in range(2)]
+        m2 = np.array(self._execute(f'SELECT {deviations} FROM {TABLE} {clause}', centers + params).fetchone(),
+                      dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+        quartiles = np.array([self._quartiles(col, int(n), filters, area) for col, n in zip(columns, count)])
+        stats = {'count': count, 'mean': mean, 'std': std, 'min': low,
+                 '25%': quartiles[:, 0], '50%': quartiles[:, 1], '75%': quartiles[:, 2], 'max': high}
+        return describe_dates(pd.DataFrame(stats, index=columns).T)
+
+    def _quartiles(self, col, count, filters, area=None, probabilities=(0.25, 0.5, 0.75)):
+        """Linearly interpolated quantiles (pandas' default) of the `count` non-missing values of `col`."""
+        if count == 0:
+            return [np.nan] * len(probabilities)
+        positions = [(count - 1) * q for q in probabilities]
+        # 1-based ranks of the two values around each position
+        ranks = sorted({int(p) + 1 for p in positions} | {min(int(p) + 2, count) for p in positions})
+        clause, params = self.where(filters, area, f'{quote(col)} IS NOT NULL')
+        rows = self._execute(
+            f'SELECT row_rank, value FROM (SELECT {quote(col)} AS value, ROW_NUMBER() OVER (ORDER BY {quote(col)}) AS row_rank '
+            f'FROM {TABLE} {clause}) AS ranked WHERE row_rank IN ({", ".join("?" * len(ranks))})', params + ranks).fetchall()
+        values = dict(rows)
+        result = []
+        for p in positions:
+            below, above = values[int(p) + 1], values[min(int(p) + 2, count)]
+            result.append(below + (above - below) * (p - int(p)))
+        return result
+
+    def page(self, filters, columns, offset, limit, area=None, sort=None, ascending=True):
+        """Rows `offset` to `offset + limit` of the selection, in file order or by `sort` (missing values last)."""
+        clause, params = self.where(filters, area)
+        # rowid is the file order; it breaks ties so sorts are stable, as in sorted_rows()
+        order = 'rowid' if sort is None else f'{quote(sort)} {"ASC" if ascending else "DESC"} NULLS LAST, rowid'
+        select = ', '.join(quote(col) for col in columns) or 'rowid'
+        frame = self._frame(f'SELECT {select} FROM {TABLE} {clause} ORDER BY {order} LIMIT ? OFFSET ?',
+                            params + [limit, offset])
+        return from_sql_types(frame[list(columns)], self.values)
+
+    def sample(self, filters, n, columns, area=None):
+        """`n` rows of the selection with coordinates, the same pseudo-random ones on every call."""
+        clause, params = self.where(filters, area, '"Latitude" IS NOT NULL', '"Longitude" IS NOT NULL')
+        select = ', '.join(quote(col) for col in columns)
+        # A multiplicative hash of the row number shuffles the rows reproducibly in both engines
+        frame = self._frame(f'SELECT {select} FROM {TABLE} {clause} ORDER BY (rowid * 2654435761) % 4294967296 '
+                            f'LIMIT ?', params + [n])
+        return from_sql_types(frame, self.values)
+
+    def spatial_grid(self, filters, zoom, area=None, max_cells=MAP_MAX_CELLS):
+        """Incidents (and arrests) per grid cell, as spatial_grid(); the points are binned in SQL."""
+        size = grid_cell_size(zoom)
+        clause, params = self.where(filters, area, '"Latitude" IS NOT NULL', '"Longitude" IS NOT NULL')
+        arrests = ', SUM(CAST("Arrest" AS INTEGER)) AS "Arrests"' if 'Arrest' in self.columns else ''
+        cells = self._frame(f'SELECT CAST(floor("Latitude" / ?) AS BIGINT) AS "row", '
+                            f'CAST(floor("Longitude" / ?) AS BIGINT) AS "col"{arrests}, COUNT(*) AS "Incidents" '
+                            f'FROM {TABLE} {clause} GROUP BY 1, 2', [size, size] + params)
+        return merge_grid(cells.set_index(['row', 'col']).astype(np.int64), size, max_cells)
+
+
+class SQLiteDatabase(CrimeDatabase):
+    """The crimes table in a SQLite file, indexed on the filter columns."""
+
+    engine = 'sqlite'
+
+    @staticmethod
+    def build(chunks, path):
+        connection = sqlite3.connect(path)
+        try:
+            # A fresh file that is published only once complete: no journal needed
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            for chunk in chunks:
+                chunk.to_sql(TABLE, connection, index=False, if_exists='append')
+            columns = [column[0] for column in connection.execute(f'SELECT * FROM {TABLE} LIMIT 0').description]
+            for col in SQLITE_INDEXES:
+                if col in columns:
+                    connection.execute(f'CREATE INDEX {quote("by " + col)} ON {TABLE} ({quote(col)})')
+            connection.execute('ANALYZE')
+            connection.commit()
+        finally:
+            connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(f'file:{pathname2url(os.path.abspath(self.path))}?mode=ro', uri=True)
+        connection.execute('PRAGMA mmap_size = 1073741824')
+        try:
+            connection.execute('SELECT sin(0)')
+        except sqlite3.OperationalError:
+            # SQLite built without its math functions: the area filter's come from Python
+            for name, fn, args in [('sin', math.sin, 1), ('cos', math.cos, 1), ('asin', math.asin, 1),
+                                   ('sqrt', math.sqrt, 1), ('radians', math.radians, 1), ('power', math.pow, 2),
+                                   ('floor', math.floor, 1)]:
+                connection.create_function(name, args, fn, deterministic=True)
+        return connection
+
+    def div(self, expression, divisor):
+        return f'({expression}) / {divisor}'
+
+    def year_month(self, expression):
+        return tuple(f"CAST(strftime('{part}', {expression}, 'unixepoch') AS INTEGER)" for part in ['%Y', '%m'])
+
+
+class DuckDBDatabase(CrimeDatabase):
+    """The crimes table in a DuckDB file: columnar, compressed and scanned in parallel."""
+
+    engine = 'duckdb'
+
+    def __init__(self, path):
+        self._database = duckdb.connect(path, read_only=True)
+        super().__init__(path)
+
+    @staticmethod
+    def build(chunks, path):
+        connection = duckdb.connect(path)
+        try:
+            for i, chunk in enumerate(chunks):
+                connection.register('chunk', chunk)
+                connection.execute(f'CREATE TABLE {TABLE} AS SELECT * FROM chunk' if i == 0
+                                   else f'INSERT INTO {TABLE} SELECT * FROM chunk')
+                connection.unregister('chunk')
+        finally:
+            connection.close()
+
+    def connect(self):
+        # Cursors are separate connections to the one open database
+        return self._database.cursor()
+
+    def _frame(self, sql, params=()):
+        # Fetched column by column, not as a Python tuple per row
+        return self._execute(sql, params).fetchdf()
+
+    def div(self, expression, divisor):
+        return f'({expression}) // {divisor}'
+
+    def year_month(self, expression):
+        stamp = f'epoch_ms(({expression}) * 1000)'
+        return f'year({stamp})', f'month({stamp})'
+
+    def describe(self, filters, area=None):
+        """describe() of the numeric columns and Date for the selection, exact, in one scan."""
+        clause, params = self.where(filters, area)
+        columns = self.numeric_columns
+        measures = DESCRIBE_STATS
+        aggregates = ', '.join(
+            f'COUNT({col}), AVG({col}), STDDEV_SAMP({col}), MIN({col}), QUANTILE_CONT({col}, 0.25), '
+            f'QUANTILE_CONT({col}, 0.5), QUANTILE_CONT({col}, 0.75), MAX({col})'
+            for col in map(quote, columns))
+        row = self._execute(f'SELECT {aggregates} FROM {TABLE} {clause}', params).fetchone()
+        values = np.array([np.nan if value is None else value for value in row], dtype=float)
+        stats = pd.DataFrame(values.reshape(len(columns), len(measures)).T, index=measures, columns=columns)
+        return describe_dates(stats)
+
+
+DATABASES = {'duckdb': DuckDBDatabase, 'sqlite': SQLiteDatabase}
+
+
+def database_path(path, engine=DEFAULT_SQL_ENGINE, folder=None):
+    """Database file for `path`, kept with its snapshots and keyed the same way (see snapshot_path())."""
+    return snapshot_path(path, folder, version=SQL_VERSION, ext=f'.{engine}')
+
+
+def open_database(path='dataset.csv', engine=DEFAULT_SQL_ENGINE, folder=None):
+    """Open the crime database of a CSV (or directory of CSV shards), building it on first use.
+
+    The CSV is streamed into the database in chunks, so building it needs
+    memory for one chunk, not the whole dataset.
+    """
+    if engine not in DATABASES:
+        raise ValueError(f"Unknown SQL engine {engine!r}; use one of {SQL_ENGINES}")
+    if engine == 'duckdb' and duckdb is None:
+        raise ImportError("The duckdb SQL engine needs the duckdb package; install it or use 'sqlite'")
+    database = DATABASES[engine]
+    db_path = database_path(path, engine, folder)
+    if not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        tmp = f"{db_path}.{os.getpid()}.tmp"
+        try:
+            database.build(sql_chunks(path), tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        publish_snapshot(tmp, db_path)
+    return database(db_path)
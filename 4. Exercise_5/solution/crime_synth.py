@@ -0,0 +1,307 @@
+"""Synthetic Chicago crime data at any scale, learned from a sample such as dataset.csv.
+
+CrimeModel learns the joint distribution of the key columns as a chain of
+conditionals, each one smoothed toward its marginal so that combinations
+a small sample never shows still turn up now and then:
+
+    Year -> Primary Type -> Location Description, (Arrest, Domestic), District
+
+The remaining fields are copied from a sampled "donor" row, which keeps
+them consistent with each other. The offense fields (IUCR, Description,
+FBI Code) come from a row of the same Primary Type. The place fields
+(Beat, Block, Ward, Community Area, coordinates) come from a row of the
+same District. Coordinates are jittered by a per-district kernel
+bandwidth. Dates take their day of the year from a row of the same Year
+and their time of day from any row.
+
+write_synthetic() writes CSV or Parquet in chunks, each generated and
+written by a pool worker, so memory stays bounded by the chunk size
+whatever the row count. Every chunk has its own seed, so the output
+depends on the seed but not on the number of workers.
+
+    python crime_synth.py ../exercise_files/dataset.csv crimes_10M.csv --rows 10M
+"""
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from crime_data import CSV_DTYPES, DATE_FORMATS, csv_dtypes, parse_timestamps, to_bool
+
+# Rows generated (and held) by one worker at a time
+CHUNK_ROWS = 250_000
+# Weight of the marginal in every conditional, in rows: larger is smoother
+SMOOTHING = 5.0
+# Dates move up to this many days from their donor's day of the year
+JITTER_DAYS = 7
+SIZE_SUFFIXES = {'k': 1_000, 'M': 1_000_000, 'G': 1_000_000_000}
+OFFENSE_COLUMNS = ['IUCR', 'Description', 'FBI Code']
+PLACE_COLUMNS = ['Beat', 'Block', 'Ward', 'Community Area']
+
+
+def parse_rows(text):
+    """'10k' -> 10000, '1M' -> 1000000, '2500' -> 2500."""
+    if text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def conditional(parent, child, n_parent, n_child, smoothing=SMOOTHING):
+    """Cumulative P(child | parent) per parent code, smoothed toward P(child)."""
+    counts = np.zeros((n_parent, n_child))
+    np.add.at(counts, (parent, child), 1)
+    marginal = counts.sum(axis=0) / counts.sum()
+    probs = (counts + smoothing * marginal) / (counts.sum(axis=1, keepdims=True) + smoothing)
+    return np.cumsum(probs, axis=1)
+
+
+def draw(cumulative, parent, rng):
+    """One child code per parent code, from the rows of `cumulative`."""
+    u = rng.random(len(parent))
+    codes = np.empty(len(parent), dtype=np.int64)
+    # One parent at a time keeps the searches small: no (rows x children) matrix
+    for code in np.unique(parent):
+        rows = parent == code
+        codes[rows] = np.searchsorted(cumulative[code], u[rows], side='right')
+    return np.minimum(codes, cumulative.shape[1] - 1)
+
+
+class Groups:
+    """The sample's rows grouped by a code, to pick a random row of a given code."""
+
+    def __init__(self, codes, n):
+        self.order = np.argsort(codes, kind='stable')
+        self.counts = np.bincount(codes, minlength=n)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def pick(self, codes, rng):
+        offsets = (rng.random(len(codes)) * self.counts[codes]).astype(np.int64)
+        return self.order[self.starts[codes] + offsets]
+
+
+class CrimeModel:
+    """Distributions of a crime sample, and sampling of any number of rows from them."""
+
+    def __init__(self, sample, smoothing=SMOOTHING):
+        self.columns = list(sample.columns)
+        self.rows = sample.reset_index(drop=True)
+        self.smoothing = smoothing
+        self.codes = {}
+        self.values = {}
+        for col in ['Year', 'Primary Type', 'Location Description', 'District']:
+            # Missing values are a value of their own, sampled as often as they occur
+            self.codes[col], self.values[col] = pd.factorize(self.rows[col], use_na_sentinel=False)
+        flags = self.rows['Arrest'].astype(int).to_numpy() * 2 + self.rows['Domestic'].astype(int).to_numpy()
+        self.codes['flags'] = flags
+
+        n = {col: len(values) for col, values in self.values.items()}
+        year, kind = self.codes['Year'], self.codes['Primary Type']
+        self.year = np.cumsum(np.bincount(year, minlength=n['Year']) / len(year))
+        self.kind = conditional(year, kind, n['Year'], n['Primary Type'], smoothing)
+        self.location = conditional(kind, self.codes['Location Description'], n['Primary Type'],
+                                    n['Location Description'], smoothing)
+        self.flags = conditional(kind, flags, n['Primary Type'], 4, smoothing)
+        self.district = conditional(kind, self.codes['District'], n['Primary Type'], n['District'], smoothing)
+        self.by_year = Groups(year, n['Year'])
+        self.by_kind = Groups(kind, n['Primary Type'])
+        self.by_district = Groups(self.codes['District'], n['District'])
+        self._fit_dates()
+        self._fit_coordinates()
+
+    @classmethod
+    def from_csv(cls, path, smoothing=SMOOTHING):
+        """Fit to a crime CSV; its numeric columns keep their CSV types (e.g. Beat as int)."""
+        columns, _ = csv_dtypes(path)
+        sample = pd.read_csv(path, dtype={col: 'string' for col in columns if col not in CSV_DTYPES})
+        for col in ['Date', 'Updated On']:
+            sample[col] = parse_timestamps(sample[col])
+        for col in ['Arrest', 'Domestic']:
+            sample[col] = to_bool(sample[col]).fillna(False).astype(bool)
+        return cls(sample, smoothing)
+
+    def _fit_dates(self):
+        date = self.rows['Date']
+        year_start = pd.to_datetime(date.dt.year.astype(str), format='%Y')
+        self.day_of_year = ((date - year_start).dt.days).to_numpy()
+        self.time_of_day = (date - date.dt.normalize()).dt.total_seconds().to_numpy().astype(np.int64)
+        self.update_lag = (self.rows['Updated On'] - date).dt.total_seconds().to_numpy()
+        # The last day a year may have: its end, or the last date seen in the (current) final year
+        last_seen = date.max()
+        self.last_day = np.array([
+            (last_seen - pd.Timestamp(year=int(year), month=1, day=1)).days if int(year) == last_seen.year
+            else 365 + pd.Timestamp(year=int(year), month=1, day=1).is_leap_year - 1
+            for year in self.values['Year']])
+
+    def _fit_coordinates(self):
+        located = self.rows[['Latitude', 'Longitude', 'X Coordinate', 'Y Coordinate']].dropna()
+        # State plane X/Y are (nearly) a linear function of latitude/longitude at city scale
+        design = np.column_stack([located['Latitude'], located['Longitude'], np.ones(len(located))])
+        self.xy, *_ = np.linalg.lstsq(design, located[['X Coordinate', 'Y Coordinate']].to_numpy(), rcond=None)
+        # Per-district kernel bandwidth, by Scott's rule for 2-D: spread * n^(-1/6)
+        spread = self.rows.groupby(self.codes['District'])[['Latitude', 'Longitude']].agg(['std', 'count'])
+        bandwidth = np.column_stack([spread[(col, 'std')] * spread[(col, 'count')] ** (-1 / 6)
+                                     for col in ['Latitude', 'Longitude']])
+        fallback = np.nanmedian(bandwidth, axis=0)
+        bandwidth = np.where(np.isnan(bandwidth), fallback, bandwidth)
+        self.bandwidth = np.zeros((len(self.values['District']), 2))
+        self.bandwidth[spread.index.to_numpy()] = bandwidth
+
+    def sample(self, n, rng, first_id=1):
+        """A frame of `n` synthetic rows with IDs first_id, first_id + 1, ..., in the sample's columns."""
+        year = np.minimum(np.searchsorted(self.year, rng.random(n), side='right'), len(self.year) - 1)
+        kind = draw(self.kind, year, rng)
+        location = draw(self.location, kind, rng)
+        flags = draw(self.flags, kind, rng)
+        district = draw(self.district, kind, rng)
+        offense = self.by_kind.pick(kind, rng)
+        place = self.by_district.pick(district, rng)
+        when = self.by_year.pick(year, rng)
+        other = rng.integers(0, len(self.rows), n)
+
+        out = self.rows.take(other).reset_index(drop=True)  # Any column not modelled below
+        ids = np.arange(first_id, first_id + n)
+        out['ID'] = ids
+        if 'Case Number' in out.columns:
+            # Unique, in the portal's two-letters-six-digits layout
+            letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))[(ids // 1_000_000) % 26]
+            out['Case Number'] = pd.Series(np.char.add(np.char.add('J', letters),
+                                                       np.char.zfill((ids % 1_000_000).astype(str), 6)))
+        out['Year'] = self.values['Year'][year]
+        out['Primary Type'] = self.values['Primary Type'][kind]
+        out['Location Description'] = pd.array(self.values['Location Description'][location], dtype='string')
+        out['Arrest'] = flags >= 2
+        out['Domestic'] = flags % 2 == 1
+        out['District'] = self.values['District'][district]
+        for col in OFFENSE_COLUMNS:
+            if col in out.columns:
+                out[col] = self.rows[col].to_numpy()[offense]
+        for col in PLACE_COLUMNS:
+            if col in out.columns:
+                out[col] = self.rows[col].to_numpy()[place]
+
+        day = self.day_of_year[when] + rng.integers(-JITTER_DAYS, JITTER_DAYS + 1, n)
+        day = np.clip(day, 0, self.last_day[year])
+        starts = pd.to_datetime(pd.Series(out['Year'].astype(str)), format='%Y').to_numpy(dtype='datetime64[s]')
+        date = starts + day.astype('timedelta64[D]') + self.time_of_day[other].astype('timedelta64[s]')
+        out['Date'] = date
+        lag = self.update_lag[when]
+        out['Updated On'] = date + np.where(np.isnan(lag), np.timedelta64('NaT'), np.maximum(np.nan_to_num(lag), 0)
+                                            .astype('timedelta64[s]'))
+
+        noise = rng.normal(size=(n, 2)) * self.bandwidth[district]
+        lat = self.rows['Latitude'].to_numpy()[place] + noise[:, 0]
+        lon = self.rows['Longitude'].to_numpy()[place] + noise[:, 1]
+        out['Latitude'] = lat.round(9)
+        out['Longitude'] = lon.round(9)
+        xy = np.column_stack([lat, lon, np.ones(n)]) @ self.xy
+        out['X Coordinate'] = xy[:, 0].round()
+        out['Y Coordinate'] = xy[:, 1].round()
+        if 'Location' in out.columns:
+            text = pd.Series('(' + out['Latitude'].astype(str) + ', ' + out['Longitude'].astype(str) + ')',
+                             dtype='string')
+            out['Location'] = text.where(~np.isnan(lat))
+        return out[self.columns]
+
+
+def format_timestamps(series, fmt=DATE_FORMATS[0]):
+    """Timestamps as text (NaT as missing), formatting each distinct day and time of day once.
+
+    strftime per row is most of the cost of writing a CSV; a chunk only
+    holds a few thousand distinct days and times of day.
+    """
+    values = series.to_numpy(dtype='datetime64[s]')
+    missing = np.isnat(values)
+    values = np.where(missing, np.datetime64(0, 's'), values)
+    day = values.astype('datetime64[D]')
+    seconds = (values - day).astype(np.int64)
+    day_format, time_format = fmt.split(' ', 1)
+    days, day_codes = np.unique(day, return_inverse=True)
+    times, time_codes = np.unique(seconds, return_inverse=True)
+    day_text = pd.DatetimeIndex(days).strftime(day_format).to_numpy(dtype=str)
+    time_text = pd.to_datetime(times, unit='s').strftime(time_format).to_numpy(dtype=str)
+    text = np.char.add(np.char.add(day_text[day_codes], ' '), time_text[time_codes])
+    return pd.Series(text, index=series.index, dtype='string').mask(missing)
+
+
+def output_format(path):
+    return 'parquet' if path.endswith(('.parquet', '.pq')) else 'csv'
+
+
+def _write_chunk(model, first_id, n, seed, path, fmt, header):
+    """Generate one chunk and write it to its own part file; runs in a pool worker."""
+    chunk = model.sample(n, np.random.default_rng(seed), first_id)
+    if fmt == 'parquet':
+        pq.write_table(pa.Table.from_pandas(chunk, preserve_index=False), path)
+    else:
+        for col in ['Date', 'Updated On']:
+            chunk[col] = format_timestamps(chunk[col])
+        chunk.to_csv(path, index=False, header=header)
+    return n
+
+
+def write_synthetic(model, rows, out, seed=0, chunk_rows=CHUNK_ROWS, workers=None):
+    """Write `rows` synthetic rows to `out` (.csv, or .parquet), generated in chunks by `workers` processes.
+
+    Workers write their chunks to part files, which are then appended to
+    the output in order, a chunk at a time. The output appears (atomically)
+    once complete.
+    """
+    fmt = output_format(out)
+    parts = f"{out}.{os.getpid()}.parts"
+    os.makedirs(parts, exist_ok=True)
+    starts = list(range(0, rows, chunk_rows)) or [0]
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    paths = [os.path.join(parts, f"{i:06d}.{fmt}") for i in range(len(starts))]
+    tmp = f"{out}.{os.getpid()}.tmp"
+    try:
+        jobs = [(model, start + 1, min(chunk_rows, rows - start), seeds[i], paths[i], fmt, i == 0)
+                for i, start in enumerate(starts)]
+        if workers == 1 or len(jobs) == 1:
+            for job in jobs:
+                _write_chunk(*job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_write_chunk, *zip(*jobs)))
+        if fmt == 'parquet':
+            schema = pq.read_schema(paths[0])
+            with pq.ParquetWriter(tmp, schema) as writer:
+                for path in paths:
+                    writer.write_table(pq.read_table(path, schema=schema))
+        else:
+            with open(tmp, 'wb') as target:
+                for path in paths:
+                    with open(path, 'rb') as part:
+                        shutil.copyfileobj(part, target)
+        os.replace(tmp, out)
+    finally:
+        shutil.rmtree(parts, ignore_errors=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', help='the sample to learn from')
+    parser.add_argument('out', help='output file: .csv, or .parquet')
+    parser.add_argument('--rows', default='1M', help='rows to write (k/M/G suffixes)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--workers', type=int, default=None, help='generator processes (default: one per core)')
+    args = parser.parse_args()
+
+    model = CrimeModel.from_csv(args.csv)
+    rows = parse_rows(args.rows)
+    start = time.perf_counter()
+    write_synthetic(model, rows, args.out, args.seed, args.chunk_rows, args.workers)
+    seconds = time.perf_counter() - start
+    print(f"{rows:,} rows in {seconds:.1f} s ({rows / seconds:,.0f} rows/s): {args.out}")
+
+
+if __name__ == '__main__':
+    main()
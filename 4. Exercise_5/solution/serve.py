@@ -0,0 +1,118 @@
+"""Start the dashboard with a hot cache.
+
+Builds the dataset, its indexes and aggregates (crime_resources) before
+Streamlit starts listening, so no visitor waits on a cold process and
+Streamlit's own /_stcore/health only passes once the cache is hot.
+Meanwhile a readiness endpoint reports the prewarm's progress: GET /ready
+on --ready-port answers 503 while warming and 200 once ready. The same
+port serves GET /metrics: the latency of every rerun stage, across all
+sessions, in the Prometheus text format. It listens on --ready-host,
+127.0.0.1 unless the probes come from elsewhere.
+
+With --ingest it also accepts POST /ingest: a CSV of new and updated
+incidents, upserted into the served data without a reload (e.g. from a
+daily job, see crime_ingest.py). Writes need the shared token from
+CRIME_INGEST_TOKEN (or --ingest-token) as a bearer token:
+
+    curl -H "Authorization: Bearer $CRIME_INGEST_TOKEN" --data-binary @updates.csv http://localhost:8502/ingest
+
+Run it from the folder holding the data, like `streamlit run`; arguments
+after -- go to streamlit:
+
+    cd ../exercise_files && python ../solution/serve.py --ready-port 8502 -- --server.port 8501
+"""
+import argparse
+import hmac
+import io
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from streamlit.web import cli as stcli
+
+from crime_resources import ingest_updates, is_ready, load_stage_timings, readiness, start_prewarm, wait_ready
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit-app.py')
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    # Shared secret of POST /ingest; None leaves ingestion off
+    ingest_token = None
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/ready':
+            state = readiness()
+            self.reply(200 if state['ready'] else 503, 'application/json', json.dumps(state))
+        elif path == '/metrics':
+            self.reply(200, 'text/plain; version=0.0.4', load_stage_timings().prometheus())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.ingest_token is None or self.path.rstrip('/') != '/ingest':
+            self.send_error(404)
+            return
+        expected = f"Bearer {self.ingest_token}".encode()
+        if not hmac.compare_digest(self.headers.get('Authorization', '').encode(), expected):
+            self.reply(401, 'application/json', json.dumps({'error': 'missing or wrong ingest token'}))
+            return
+        if not is_ready():
+            self.reply(503, 'application/json', json.dumps({'error': 'still warming up'}))
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            report = ingest_updates(io.BytesIO(body))
+        except Exception as error:
+            self.reply(400, 'application/json', json.dumps({'error': f"{type(error).__name__}: {error}"}))
+            return
+        self.reply(200, 'application/json', json.dumps(report))
+
+    def reply(self, status, content_type, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Probes every few seconds would flood the server log
+
+
+def serve_readiness(port, host='127.0.0.1', ingest_token=None):
+    handler = type('Handler', (StatusHandler,), {'ingest_token': ingest_token})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='crime-readiness', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ready-port', type=int, default=int(os.environ.get('CRIME_READY_PORT', 8502)),
+                        help='port of the /ready and /metrics endpoints (0 to disable)')
+    parser.add_argument('--ready-host', default=os.environ.get('CRIME_READY_HOST', '127.0.0.1'),
+                        help="interface they listen on ('' or 0.0.0.0 for all)")
+    parser.add_argument('--ingest', action='store_true', help='accept POST /ingest of incident updates on that port')
+    parser.add_argument('--ingest-token', default=os.environ.get('CRIME_INGEST_TOKEN'),
+                        help='shared token /ingest requires (prefer CRIME_INGEST_TOKEN: arguments show in ps)')
+    parser.add_argument('streamlit_args', nargs='*', help='passed on to `streamlit run`')
+    args = parser.parse_args()
+    if args.ingest and not args.ingest_token:
+        parser.error('--ingest needs a shared token: set CRIME_INGEST_TOKEN or pass --ingest-token')
+
+    if args.ready_port:
+        serve_readiness(args.ready_port, args.ready_host, args.ingest_token if args.ingest else None)
+    start_prewarm()
+    if not wait_ready():
+        sys.exit(f"Prewarm failed: {readiness()['error']}")
+    stages = ', '.join(f"{stage} {seconds:.2f} s" for stage, seconds in readiness()['seconds'].items())
+    print(f"Cache is hot ({stages}); starting Streamlit", flush=True)
+    sys.argv = ['streamlit', 'run', APP, *args.streamlit_args]
+    sys.exit(stcli.main())
+
+
+if __name__ == '__main__':
+    main()
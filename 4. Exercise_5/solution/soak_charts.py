@@ -0,0 +1,67 @@
+"""Soak test: render the Visualizations charts over and over and watch memory.
+
+Each iteration draws one chart for a random filter combination, the way a
+dashboard rerun with an image-cache miss would. Process RSS and the number
+of figures in the pyplot registry are printed at regular checkpoints; both
+should stay flat.
+
+    python soak_charts.py ../exercise_files/dataset.csv --reruns 10000
+"""
+import argparse
+import gc
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from crime_aggregates import CrimeCube
+from crime_charts import chart_spec, render_png
+from crime_data import load_crime_data
+from crime_profiling import process_memory, format_bytes
+
+
+def random_filters(df, rng):
+    filters = {}
+    for col in ['Year', 'Primary Type', 'Location Description']:
+        if rng.random() < 0.5:
+            filters[col] = list(rng.choice(df[col].cat.categories, rng.integers(1, 4)))
+    return filters
+
+
+def build_spec(cube, filters, viz):
+    if viz == 'year':
+        return chart_spec('line', cube.counts(filters, 'Year'), 'Crime Incidents by Year',
+                          'Year', 'Number of Incidents', 'crimson', grid=True)
+    if viz == 'arrests':
+        return chart_spec('barh', cube.arrest_rates(filters, 'Primary Type').sort_values().tail(15),
+                          'Top 15 Crime Types by Arrest Rate', 'Arrest Rate (%)', 'Crime Type', 'orange')
+    column = 'Primary Type' if viz == 'types' else 'Location Description'
+    return chart_spec('barh', cube.counts(filters, column).sort_values().tail(15),
+                      f'Top 15 {column} Values', 'Number of Incidents', column, 'steelblue')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='dataset.csv')
+    parser.add_argument('--reruns', type=int, default=10_000)
+    parser.add_argument('--every', type=int, default=1000, help='print a checkpoint every N reruns')
+    args = parser.parse_args()
+
+    df = load_crime_data(args.csv)
+    cube = CrimeCube(df)
+    rng = np.random.default_rng(0)
+    vizzes = ['types', 'year', 'locations', 'arrests']
+    baseline = None
+    for rerun in range(1, args.reruns + 1):
+        spec = build_spec(cube, random_filters(df, rng), vizzes[rerun % len(vizzes)])
+        if len(spec['data']):
+            render_png(spec)
+        if rerun % args.every == 0 or rerun == args.reruns:
+            gc.collect()
+            rss, peak = process_memory()
+            baseline = baseline or rss
+            print(f"rerun {rerun:6d}: RSS {format_bytes(rss)} ({format_bytes(rss - baseline):>10} since first "
+                  f"checkpoint), peak {format_bytes(peak)}, pyplot figures open: {len(plt.get_fignums())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,25 @@
+import time
+import uuid
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.express as px
 import plotly.graph_objects as go
+from crime_data import category_options
+from crime_index import sample_rows, sorted_rows, page_rows
+from crime_aggregates import (CrimeCube, describe_frame, filter_key, flag_rates, spatial_grid, AREA_COLUMNS, MAP_MAX_CELLS,
+                              TIME_GRAINS)
+from crime_charts import chart_spec, render_png, client_colors
+from crime_query import Lazy
+from crime_profiling import process_memory, mapped_memory, format_bytes, arrow_payload
+from crime_resources import (current_data, ingest_updates, load_database, load_aggregate_cache, load_query_backend,
+                             load_stage_timings, start_prewarm, wait_ready, is_ready, readiness,
+                             ADMIN_TAB, CACHE_MODE, DATA_ENGINE)
+
+# The cached frame is shared by every session; with copy-on-write a session
+# can never modify it in place (always on from pandas 3.0)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
 # Set page configuration
 st.set_page_config(
@@ -12,29 +28,47 @@ st.set_page_config(
     layout="wide"
 )
 
-# Load the dataset
-@st.cache_data
-def load_data():
-    df = pd.read_csv('dataset.csv')
-    # Convert Date column to datetime
-    if 'Date' in df.columns:
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-    # Convert Year to numeric if it exists
-    if 'Year' in df.columns:
-        df['Year'] = pd.to_numeric(df['Year'], errors='coerce')
-    return df
+# Every stage of a rerun (load, filter, metrics, describe, charts, map) is timed into
+# process-wide ring buffers; see the admin tab (CRIME_ADMIN_TAB=1) and serve.py's /metrics
+stage_timings = load_stage_timings()
+rerun_start = time.perf_counter()
 
-df = load_data()
+# Dataset, indexes and aggregates are process-wide cached resources (crime_resources.py).
+# serve.py builds them before the server accepts traffic; under plain `streamlit run`
+# the first session starts the same prewarm and waits for it.
+with stage_timings.timer('load'):
+    start_prewarm()
+    if not is_ready():
+        with st.spinner("Loading the crime dataset and building its indexes..."):
+            wait_ready()
+    
+    # With CRIME_DATA_ENGINE=sql the rows stay on disk: every view below is an aggregate
+    # query against the SQL database instead of a pass over the in-memory frame
+    database = load_database() if DATA_ENGINE == 'sql' else None
+    if database is None:
+        # One consistent version of the data for the whole rerun, incremental updates included
+        data = current_data()
+        df, filter_index, spatial_index = data.df, data.filter_index, data.spatial_index
+        cube, describe_sketch, timeline = data.cube, data.describe_sketch, data.timeline
+        columns, total_rows, data_version = list(df.columns), len(df), data.version
+    else:
+        columns, total_rows, data_version = database.columns, database.n_rows, 0
+    aggregate_cache = load_aggregate_cache()
+    query_backend = load_query_backend()
 
 # Title
 st.title("🚨 Chicago Crime Incidents Dashboard")
 st.markdown("Explore police-reported crime incidents in Chicago from 2001 onward")
+query_status = st.empty()
 
 # Sidebar for filters
 st.sidebar.header("🔍 Filters")
 
+def filter_options(col):
+    return database.values[col] if database is not None else category_options(df.dtypes[col])
+
 # Year filter
-years = sorted(df['Year'].dropna().unique())
+years = filter_options('Year')
 selected_years = st.sidebar.multiselect(
     "Select Year(s)",
     options=years,
@@ -42,7 +76,7 @@ selected_years = st.sidebar.multiselect(
 )
 
 # Primary Type filter
-crime_types = sorted(df['Primary Type'].dropna().unique())
+crime_types = filter_options('Primary Type')
 selected_crime_types = st.sidebar.multiselect(
     "Select Crime Type(s)",
     options=crime_types,
@@ -50,7 +84,7 @@ selected_crime_types = st.sidebar.multiselect(
 )
 
 # Location Description filter
-location_descriptions = sorted(df['Location Description'].dropna().unique())
+location_descriptions = filter_options('Location Description')
 selected_locations = st.sidebar.multiselect(
     "Select Location Description(s)",
     options=location_descriptions,
@@ -65,64 +99,214 @@ selected_arrest = st.sidebar.selectbox(
     index=0
 )
 
-# Apply filters
-filtered_df = df.copy()
+# Area filter, answered by the spatial index
+st.sidebar.subheader("📍 Area")
+area = None
+if st.sidebar.checkbox("Only incidents near a point", value=False):
+    area_lat = st.sidebar.number_input("Latitude", value=41.8781, format="%.4f")
+    area_lon = st.sidebar.number_input("Longitude", value=-87.6298, format="%.4f")
+    area_km = st.sidebar.number_input("Radius (km)", min_value=0.1, value=1.0, step=0.5)
+    area = (area_lat, area_lon, area_km)
 
-if selected_years and 'Year' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['Year'].isin(selected_years)]
+# Apply filters: resolve the selection on the bitmap and spatial indexes, then take the rows once
+filters = {
+    'Year': selected_years,
+    'Primary Type': selected_crime_types,
+    'Location Description': selected_locations,
+}
+if selected_arrest != 'All':
+    filters['Arrest'] = [selected_arrest == 'Yes']
 
-if selected_crime_types and 'Primary Type' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['Primary Type'].isin(selected_crime_types)]
+# Cube rollups are cached per filter combination, so reruns from other
+# widgets such as the viz selector or the map slider reuse them
+filters_key = filter_key(filters) + ((('Area', area),) if area else ())
 
-if selected_locations and 'Location Description' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['Location Description'].isin(selected_locations)]
+def cached_rollup(name, compute):
+    return aggregate_cache.get_or_compute((name, filters_key, data_version), compute)
 
-if selected_arrest != 'All' and 'Arrest' in filtered_df.columns:
-    arrest_bool = selected_arrest == 'Yes'
-    filtered_df = filtered_df[filtered_df['Arrest'] == arrest_bool]
+with stage_timings.timer('filter'):
+    if database is None:
+        area_rows = spatial_index.radius(*area) if area else None
+        selected_rows = filter_index.select(filters, rows=area_rows)
+        n_rows = len(df) if selected_rows is None else len(selected_rows)
+    else:
+        n_rows = cached_rollup('count', lambda: database.count(filters, area))
 
-# Display summary statistics
-col1, col2, col3, col4 = st.columns(4)
+# Queries go through the query backend (crime_query.py), inline or in a worker pool.
+# Results render into containers reserved below as they complete (inline: right
+# away), so metric cards come first and charts later. A newer run of this
+# session cancels this run's queued queries.
+query_batch = query_backend.start_batch(st.session_state.setdefault('query_session', uuid.uuid4().hex))
 
-with col1:
-    st.metric("Total Incidents", len(filtered_df))
+def submit_rollup(stage, name, compute):
+    """Submit a cached aggregate; its time (a cache hit or the computation) is recorded under `stage`."""
+    return query_batch.submit(stage_timings.timed(stage, cached_rollup), name, compute)
 
-with col2:
-    if 'Arrest' in filtered_df.columns:
-        arrest_count = filtered_df['Arrest'].sum() if filtered_df['Arrest'].dtype == bool else (filtered_df['Arrest'] == True).sum()
-        st.metric("Arrests Made", int(arrest_count))
-    else:
-        st.metric("Arrests Made", "N/A")
+# The filtered rows, taken by the first query of this run that needs them and shared by the
+# rest (in memory only); a run whose queries are all aggregate cache hits copies no rows
+filtered_frame = Lazy(stage_timings.timed('take', lambda: df.take(selected_rows)))
 
-with col3:
-    if 'Primary Type' in filtered_df.columns:
-        unique_crimes = filtered_df['Primary Type'].nunique()
-        st.metric("Crime Types", unique_crimes)
-    else:
-        st.metric("Crime Types", "N/A")
+# Rows for the counts and sums of the views below: the filtered rows, or without a filter
+# the frame's pieces (the mapped rows and the updated ones), so no view copies every row
+def counted_rows():
+    return df.pieces() if selected_rows is None else filtered_frame()
 
-with col4:
-    if 'Year' in filtered_df.columns:
-        year_range = f"{int(filtered_df['Year'].min())}-{int(filtered_df['Year'].max())}"
-        st.metric("Year Range", year_range)
-    else:
-        st.metric("Year Range", "N/A")
+# The cube has no coordinates, so an area selection gets a small cube of its own rows
+def view_cube():
+    if area is None:
+        return cube, filters
+    return cached_rollup('area_cube', lambda: CrimeCube(filtered_frame())), {}
+
+# Aggregates of the current selection, from the SQL database or the in-memory cube and rollups
+def view_metrics():
+    if database is not None:
+        return database.metrics(filters, area)
+    selection_cube, selection_filters = view_cube()
+    return selection_cube.metrics(selection_filters)
+
+def view_counts(by):
+    if database is not None:
+        return database.counts(filters, by, area)
+    selection_cube, selection_filters = view_cube()
+    return selection_cube.counts(selection_filters, by)
+
+def view_arrest_rates(by):
+    if database is not None:
+        return database.arrest_rates(filters, by, area)
+    selection_cube, selection_filters = view_cube()
+    return selection_cube.arrest_rates(selection_filters, by)
+
+def view_flag_rates(by):
+    if database is not None:
+        return database.flag_rates(filters, by, area)
+    # Not in the cube, so computed from the filtered rows (vectorized sum/count)
+    return flag_rates(counted_rows(), by)
+
+def view_time_counts(grain, window=None):
+    if database is not None:
+        return database.time_counts(filters, grain, area, window=window)
+    return timeline.counts(selected_rows, grain, window=window)
+
+def view_top_categories(grain, window=None):
+    if database is not None:
+        return database.top_categories(filters, grain, area, n=5, window=window)
+    return timeline.top_categories(selected_rows, grain, n=5, window=window)
+
+def view_profile(by):
+    if database is not None:
+        return database.profile(filters, by, area)
+    return timeline.profile(selected_rows, by=by)
+
+def view_grid(zoom):
+    if database is not None:
+        return database.spatial_grid(filters, zoom, area)
+    return spatial_grid(counted_rows(), zoom)
+
+# Display summary statistics
+def show_metrics(metrics):
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric("Total Incidents", metrics['total'])
+    
+    with col2:
+        if metrics['arrests'] is not None:
+            st.metric("Arrests Made", metrics['arrests'])
+        else:
+            st.metric("Arrests Made", "N/A")
+    
+    with col3:
+        if metrics['crime_types'] is not None:
+            st.metric("Crime Types", metrics['crime_types'])
+        else:
+            st.metric("Crime Types", "N/A")
+    
+    with col4:
+        if metrics['year_min'] is not None and not pd.isna(metrics['year_min']):
+            year_range = f"{int(metrics['year_min'])}-{int(metrics['year_max'])}"
+            st.metric("Year Range", year_range)
+        else:
+            st.metric("Year Range", "N/A")
+
+query_batch.render_later(st.container(), submit_rollup('metrics', 'metrics', view_metrics), show_metrics)
 
 # Create tabs for different views
-tab1, tab2, tab3 = st.tabs(["📊 Data Preview", "📈 Visualizations", "🗺️ Map View"])
+tab_names = ["📊 Data Preview", "📈 Visualizations", "🗺️ Map View"]
+if ADMIN_TAB:
+    tab_names.append("⏱️ Latency")
+    if database is None:
+        tab_names.append("🔄 Updates")
+tabs = st.tabs(tab_names)
+tab1, tab2, tab3 = tabs[:3]
 
 with tab1:
     st.header("Dataset Preview")
     
-    # Show number of rows
-    st.write(f"Showing {len(filtered_df)} rows (out of {len(df)} total)")
+    # Only the visible page is serialized; sorting and column selection happen here on the server
+    page_col1, page_col2, page_col3, page_col4 = st.columns(4)
+    with page_col1:
+        page_size = st.selectbox("Rows per page", options=[25, 50, 100, 500], index=1)
+    n_pages = max(1, -(-n_rows // page_size))
+    with page_col2:
+        page_number = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1)
+    with page_col3:
+        sort_column = st.selectbox("Sort by", options=["(file order)"] + columns)
+    with page_col4:
+        sort_ascending = st.radio("Order", options=["Ascending", "Descending"], horizontal=True) == "Ascending"
+    preview_columns = st.multiselect("Columns", options=columns, default=columns)
+    
+    # Show number of rows (counted from the index selection)
+    st.write(f"{n_rows} matching rows (out of {total_rows} total)")
     
-    # Display dataframe
-    st.dataframe(filtered_df, width='stretch')
+    with stage_timings.timer('preview'):
+        if database is not None:
+            # The engine sorts and pages; only the page's rows are read
+            page_df = database.page(filters, preview_columns, (page_number - 1) * page_size, page_size, area,
+                                    None if sort_column == "(file order)" else sort_column, sort_ascending)
+        else:
+            rows = selected_rows
+            if sort_column != "(file order)":
+                rows = cached_rollup(('sorted_rows', sort_column, sort_ascending),
+                                     lambda: sorted_rows(df.take(selected_rows, [sort_column])[sort_column],
+                                                         selected_rows, sort_ascending))
+            page_df = df.take(page_rows(len(df), rows, page_number - 1, page_size), preview_columns)
+        
+        # Display dataframe
+        st.dataframe(page_df, width='stretch')
+    payload_bytes, payload_seconds = arrow_payload(page_df)
+    st.caption(f"Page payload: {format_bytes(payload_bytes)}, serialized in {payload_seconds * 1000:.1f} ms")
     
     # Show basic statistics
     st.subheader("Dataset Statistics")
-    st.dataframe(filtered_df.describe(), width='stretch')
+    if database is not None:
+        def show_stats(stats):
+            st.dataframe(stats, width='stretch')
+            st.caption(f"Computed exactly by the {database.engine} engine.")
+        
+        stats_future = submit_rollup('describe', 'describe', lambda: database.describe(filters, area))
+    elif area is None and describe_sketch.covers(filters):
+        # Merge the precomputed partition sketches instead of re-sorting every column
+        def show_stats(result):
+            stats, rank_error = result
+            st.dataframe(stats, width='stretch')
+            if rank_error == 0:
+                st.caption("Merged from per-(Year, Primary Type) sketches. Quartiles are exact: "
+                           "every selected partition is stored whole.")
+            else:
+                st.caption(f"Merged from per-(Year, Primary Type) sketches. Quartiles are approximate: "
+                           f"interpolated like describe() between ranks within {rank_error:.1%} of the rows "
+                           f"of the exact ones.")
+        
+        stats_future = submit_rollup('describe', 'describe', lambda: describe_sketch.describe(filters))
+    else:
+        # Location, arrest and area filters cut across the partitions: compute exactly
+        def show_stats(stats):
+            st.dataframe(stats, width='stretch')
+            st.caption("Computed exactly from the filtered rows.")
+        
+        stats_future = submit_rollup('describe', 'describe',
+                                     lambda: describe_frame(filtered_frame(), describe_sketch.columns))
+    query_batch.render_later(st.container(), stats_future, show_stats)
 
 with tab2:
     st.header("Data Visualizations")
@@ -130,102 +314,328 @@ with tab2:
     # Visualization type selector
     viz_type = st.selectbox(
         "Select Visualization Type",
-        options=["Crime Type Distribution", "Crimes by Year", "Location Description Distribution", 
-                 "Arrest Rate by Crime Type"]
+        options=["Crime Type Distribution", "Crimes by Year", "Crimes over Time", "Location Description Distribution", 
+                 "Arrest Rate by Crime Type", "Arrest & Domestic Rate by Area"]
+    )
+    
+    # Charts are drawn server-side to a PNG, or handed to the browser as data
+    chart_renderer = st.radio(
+        "Renderer",
+        options=["Image (server)", "Interactive (browser)"],
+        horizontal=True
     )
     
-    if viz_type == "Crime Type Distribution":
-        if 'Primary Type' in filtered_df.columns:
-            crime_counts = filtered_df['Primary Type'].value_counts().head(15)
-            fig, ax = plt.subplots(figsize=(12, 6))
-            crime_counts.plot(kind='barh', ax=ax, color='steelblue')
-            ax.set_xlabel('Number of Incidents')
-            ax.set_ylabel('Crime Type')
-            ax.set_title('Top 15 Crime Types by Frequency')
-            plt.tight_layout()
-            st.pyplot(fig)
+    def show_chart(name, build_spec):
+        # Specs and PNGs are cached per (chart, filters), so a rerun re-renders nothing
+        interactive = chart_renderer == "Interactive (browser)"
+        
+        def build():
+            spec = cached_rollup(('chart_spec', name), build_spec)
+            png = None if interactive else cached_rollup(('chart_png', name), lambda: render_png(spec))
+            return spec, png
+        
+        def draw(result):
+            spec, png = result
+            data = spec['data']
+            if png is not None:
+                st.image(png, width='stretch')
+                return
+            st.markdown(f"**{spec['title']}**")
+            if spec['kind'] == 'line':
+                st.line_chart(data, x_label=spec['xlabel'], y_label=spec['ylabel'], color=client_colors(spec))
+            else:
+                st.bar_chart(data.set_axis(data.index.astype(str)), horizontal=True, sort=False, stack=False,
+                             x_label=spec['ylabel'], y_label=spec['xlabel'], color=client_colors(spec))
+        
+        query_batch.render_later(st.container(), query_batch.submit(stage_timings.timed('chart', build)),
+                                 stage_timings.timed('chart render', draw))
+    
+    if n_rows == 0:
+        st.info("No incidents match the current filters")
+    
+    elif viz_type == "Crime Type Distribution":
+        if 'Primary Type' in columns:
+            show_chart(viz_type, lambda: chart_spec(
+                'barh',
+                view_counts('Primary Type').sort_values(ascending=False).head(15),
+                title='Top 15 Crime Types by Frequency',
+                xlabel='Number of Incidents',
+                ylabel='Crime Type',
+                color='steelblue'
+            ))
         else:
             st.warning("Primary Type column not available")
     
     elif viz_type == "Crimes by Year":
-        if 'Year' in filtered_df.columns:
-            year_counts = filtered_df['Year'].value_counts().sort_index()
-            fig, ax = plt.subplots(figsize=(12, 6))
-            year_counts.plot(kind='line', ax=ax, marker='o', color='crimson')
-            ax.set_xlabel('Year')
-            ax.set_ylabel('Number of Incidents')
-            ax.set_title('Crime Incidents by Year')
-            ax.grid(True, alpha=0.3)
-            plt.tight_layout()
-            st.pyplot(fig)
+        if 'Date' in columns:
+            def yearly_counts():
+                # Yearly buckets of the same time series as "Crimes over Time"
+                counts = view_time_counts('year')
+                return counts.set_axis(counts.index.year)
+            
+            show_chart(viz_type, lambda: chart_spec(
+                'line',
+                yearly_counts(),
+                title='Crime Incidents by Year',
+                xlabel='Year',
+                ylabel='Number of Incidents',
+                color='crimson',
+                grid=True
+            ))
+        else:
+            st.warning("Date column not available")
+    
+    elif viz_type == "Crimes over Time":
+        if 'Date' in columns:
+            grain_col, window_col, split_col = st.columns(3)
+            with grain_col:
+                grain = st.selectbox("Granularity", options=list(TIME_GRAINS) + ["hour of day", "day of week"],
+                                     index=1, format_func=str.capitalize)
+            profile = grain in ("hour of day", "day of week")
+            with window_col:
+                window = st.number_input("Rolling mean over (buckets)", min_value=1, max_value=365, value=1,
+                                         disabled=profile)
+            with split_col:
+                split = st.checkbox("Split by the top 5 crime types", disabled=profile)
+            
+            def time_spec():
+                if profile:
+                    counts = view_profile('hour' if grain == "hour of day" else 'weekday')
+                    xlabel = 'Hour of Day' if grain == "hour of day" else 'Day of Week (0 = Monday)'
+                    return chart_spec('line', counts, title=f'Crime Incidents by {xlabel}', xlabel=xlabel,
+                                      ylabel='Number of Incidents', color='crimson', grid=True)
+                if split:
+                    counts = view_top_categories(grain, window=window)
+                    color = list(sns.color_palette('tab10', len(counts.columns)))
+                else:
+                    counts = view_time_counts(grain, window=window)
+                    color = 'crimson'
+                ylabel = 'Number of Incidents' if window == 1 else f'Incidents ({window}-{grain} rolling mean)'
+                return chart_spec('line', counts, title=f'Crime Incidents per {grain.capitalize()}',
+                                  xlabel='Date', ylabel=ylabel, color=color, grid=True)
+            
+            show_chart((viz_type, grain, window, split and not profile), time_spec)
         else:
-            st.warning("Year column not available")
+            st.warning("Date column not available")
     
     elif viz_type == "Location Description Distribution":
-        if 'Location Description' in filtered_df.columns:
-            location_counts = filtered_df['Location Description'].value_counts().head(15)
-            fig, ax = plt.subplots(figsize=(12, 6))
-            location_counts.plot(kind='barh', ax=ax, color='darkgreen')
-            ax.set_xlabel('Number of Incidents')
-            ax.set_ylabel('Location Description')
-            ax.set_title('Top 15 Location Descriptions by Frequency')
-            plt.tight_layout()
-            st.pyplot(fig)
+        if 'Location Description' in columns:
+            show_chart(viz_type, lambda: chart_spec(
+                'barh',
+                view_counts('Location Description').sort_values(ascending=False).head(15),
+                title='Top 15 Location Descriptions by Frequency',
+                xlabel='Number of Incidents',
+                ylabel='Location Description',
+                color='darkgreen'
+            ))
         else:
             st.warning("Location Description column not available")
     
     elif viz_type == "Arrest Rate by Crime Type":
-        if 'Primary Type' in filtered_df.columns and 'Arrest' in filtered_df.columns:
-            # Calculate arrest rates
-            arrest_rates = filtered_df.groupby('Primary Type')['Arrest'].apply(
-                lambda x: (x == True).sum() / len(x) * 100 if len(x) > 0 else 0
-            ).sort_values(ascending=False).head(15)
-            
-            fig, ax = plt.subplots(figsize=(12, 6))
-            arrest_rates.plot(kind='barh', ax=ax, color='orange')
-            ax.set_xlabel('Arrest Rate (%)')
-            ax.set_ylabel('Crime Type')
-            ax.set_title('Top 15 Crime Types by Arrest Rate')
-            plt.tight_layout()
-            st.pyplot(fig)
+        if 'Primary Type' in columns and 'Arrest' in columns:
+            show_chart(viz_type, lambda: chart_spec(
+                'barh',
+                view_arrest_rates('Primary Type').sort_values(ascending=False).head(15),
+                title='Top 15 Crime Types by Arrest Rate',
+                xlabel='Arrest Rate (%)',
+                ylabel='Crime Type',
+                color='orange'
+            ))
         else:
             st.warning("Required columns (Primary Type, Arrest) not available")
     
+    elif viz_type == "Arrest & Domestic Rate by Area":
+        area_columns = [col for col in AREA_COLUMNS if col in columns]
+        if area_columns and 'Arrest' in columns:
+            area_column = st.selectbox("Area", options=area_columns)
+            show_chart((viz_type, area_column), lambda: chart_spec(
+                'barh',
+                view_flag_rates(area_column)
+                .sort_values('Incidents', ascending=False).head(15).sort_index().drop(columns='Incidents'),
+                title=f'Arrest and Domestic Rates for the 15 {area_column} Values with the Most Incidents',
+                xlabel='Rate (%)',
+                ylabel=area_column,
+                color=['orange', 'purple']
+            ))
+        else:
+            st.warning("Required columns (District/Ward/Community Area, Arrest) not available")
+    
 with tab3:
     st.header("Geographic Distribution")
     
-    # Filter out rows with missing coordinates (if any)
-    map_df = filtered_df.dropna(subset=['Latitude', 'Longitude'])
+    map_mode = st.radio(
+        "Map mode",
+        options=["Density grid (all incidents)", "Sample points"],
+        horizontal=True
+    )
     
-    if len(map_df) > 0:
-        st.write(f"Showing {len(map_df)} incidents with valid coordinates")
-        
-        # Limit points for performance
-        max_points = st.slider("Maximum points to display", 100, min(1000, len(map_df)), 500)
-        map_df_sample = map_df.head(max_points)
-        
-        # Create map using Plotly
-        fig = px.scatter_map(
-            map_df_sample,
-            lat='Latitude',
-            lon='Longitude',
-            hover_name='Primary Type' if 'Primary Type' in map_df_sample.columns else None,
-            hover_data=['Date', 'Description'] if 'Description' in map_df_sample.columns else ['Date'],
-            color='Primary Type' if 'Primary Type' in map_df_sample.columns else None,
-            zoom=10,
-            height=600,
-            title="Crime Incidents Map"
-        )
+    if map_mode == "Density grid (all incidents)":
+        # Aggregate server-side: every filtered incident counts, and the browser
+        # only receives at most MAP_MAX_CELLS grid cells
+        zoom = st.slider("Zoom level (sets the grid resolution)", 8, 16, 10)
         
-        fig.update_layout(
-            mapbox_style="open-street-map",
-            margin=dict(l=0, r=0, t=30, b=0)
-        )
+        def show_grid(grid):
+            if len(grid) > 0:
+                st.write(f"{int(grid['Incidents'].sum())} incidents with valid coordinates in {len(grid)} grid cells "
+                         f"of {grid['Cell Size'].iat[0] * 111:.2f} km (max {MAP_MAX_CELLS})")
+                
+                fig = px.scatter_map(
+                    grid,
+                    lat='Latitude',
+                    lon='Longitude',
+                    size='Incidents',
+                    color='Incidents',
+                    hover_data=['Arrests'] if 'Arrests' in grid.columns else None,
+                    color_continuous_scale='YlOrRd',
+                    center=dict(lat=area[0], lon=area[1]) if area else None,
+                    zoom=zoom,
+                    height=600,
+                    title="Crime Incident Density"
+                )
+                
+                fig.update_layout(
+                    mapbox_style="open-street-map",
+                    margin=dict(l=0, r=0, t=30, b=0)
+                )
+                
+                st.plotly_chart(fig, width='stretch')
+            else:
+                st.warning("No data points with valid coordinates available")
         
-        st.plotly_chart(fig, width='stretch')
+        grid_future = submit_rollup('map', ('map_grid', zoom), lambda: view_grid(zoom))
+        query_batch.render_later(st.container(), grid_future, stage_timings.timed('map render', show_grid))
+    
     else:
-        st.warning("No data points with valid coordinates available")
+        # Filter out rows with missing coordinates (if any)
+        map_start = time.perf_counter()
+        map_columns = [col for col in ['Latitude', 'Longitude', 'Primary Type', 'Date', 'Description']
+                       if col in columns]
+        if database is not None:
+            n_located = cached_rollup('located', lambda: database.count(filters, area, located=True))
+        else:
+            # The spatial index knows which rows have coordinates: only the sampled rows are taken
+            located_rows = cached_rollup('located', lambda: spatial_index.located(selected_rows))
+            n_located = len(located_rows)
+        
+        if n_located > 0:
+            st.write(f"Showing a random sample of the {n_located} incidents with valid coordinates")
+            
+            # Limit points for performance; sample randomly so the points are not biased to the file order
+            if n_located > 1:
+                max_points = st.slider("Maximum points to display", 1, min(1000, n_located), min(500, n_located))
+            else:
+                max_points = n_located  # A slider needs min < max
+            if database is not None:
+                map_df_sample = cached_rollup(('map_sample', max_points),
+                                              lambda: database.sample(filters, max_points, map_columns, area))
+            else:
+                map_df_sample = df.take(sample_rows(located_rows, max_points), map_columns)
+            stage_timings.record('map', time.perf_counter() - map_start)
+            
+            with stage_timings.timer('map render'):
+                # Create map using Plotly
+                fig = px.scatter_map(
+                    map_df_sample,
+                    lat='Latitude',
+                    lon='Longitude',
+                    hover_name='Primary Type' if 'Primary Type' in map_df_sample.columns else None,
+                    hover_data=['Date', 'Description'] if 'Description' in map_df_sample.columns else ['Date'],
+                    color='Primary Type' if 'Primary Type' in map_df_sample.columns else None,
+                    zoom=10,
+                    height=600,
+                    title="Crime Incidents Map"
+                )
+                
+                fig.update_layout(
+                    mapbox_style="open-street-map",
+                    margin=dict(l=0, r=0, t=30, b=0)
+                )
+                
+                st.plotly_chart(fig, width='stretch')
+        else:
+            st.warning("No data points with valid coordinates available")
+
+# Render the query results into their containers as they complete
+query_batch.flush(query_status)
+
+# Debug panel: memory of this process, and the peak seen by this session
+if st.sidebar.checkbox("Show debug panel", value=False):
+    current_rss, peak_rss = process_memory()
+    st.session_state['session_peak_rss'] = max(st.session_state.get('session_peak_rss', 0), current_rss or peak_rss)
+    with st.sidebar.expander("🛠️ Debug", expanded=True):
+        if database is not None:
+            st.write(f"SQL database: {database.engine}, {total_rows} rows, "
+                     f"{format_bytes(database.nbytes())} on disk")
+        else:
+            st.write(f"Cached dataset: {format_bytes(int(df.base.memory_usage(index=False).sum()))} "
+                     f"(mapped read-only from the {CACHE_MODE} snapshot)")
+            if data_version:
+                st.write(f"Incremental updates: {data_version} applied, {len(df.rows)} changed rows "
+                         f"({format_bytes(df.nbytes())}) layered over the snapshot")
+            st.write(f"Filter index: {format_bytes(filter_index.nbytes())}")
+            st.write(f"Spatial index: {format_bytes(spatial_index.nbytes())}")
+            st.write(f"Statistics sketches: {len(describe_sketch.keys)} partitions, "
+                     f"{format_bytes(describe_sketch.nbytes())}")
+            st.write(f"Aggregate cube: {len(cube.cells)} cells, {format_bytes(cube.nbytes())}")
+            if timeline is not None:
+                st.write(f"Time rollups: {len(timeline.hours)} hours x {len(timeline.categories)} types, "
+                         f"{format_bytes(timeline.nbytes())}")
+        st.write(f"Aggregate cache: {len(aggregate_cache)} entries, {format_bytes(aggregate_cache.nbytes)} "
+                 f"({aggregate_cache.hits} hits / {aggregate_cache.misses} misses)")
+        st.write(f"Query backend: {query_backend.name}"
+                 + (f" ({query_backend.workers} workers)" if query_backend.name == 'threads' else ""))
+        if database is None and not filtered_frame.done():
+            st.write("This rerun's row selection: not taken (every query was answered without the rows)")
+        elif database is None:
+            filtered_df = filtered_frame()
+            selection_bytes = 0 if filtered_df is df.base else int(filtered_df.memory_usage(index=False).sum())
+            st.write(f"This rerun's row selection: {format_bytes(selection_bytes)}")
+        if current_rss is not None:
+            st.write(f"Process RSS: {format_bytes(current_rss)}")
+        memory_split = mapped_memory()
+        if memory_split is not None:
+            st.write(f"of which private: {format_bytes(memory_split[0])}, "
+                     f"mapped (shared with other processes): {format_bytes(memory_split[1])}")
+        st.write(f"Process peak RSS: {format_bytes(peak_rss)}")
+        st.write(f"Session peak RSS: {format_bytes(st.session_state['session_peak_rss'])}")
+        warmed = readiness()['seconds']
+        if warmed:
+            st.write("Prewarm: " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in warmed.items()))
+        if database is None and 'shards' in df.attrs:
+            st.write(f"Loaded {len(df.attrs['shards'])} shards in {df.attrs['load_seconds']:.2f} s:")
+            st.dataframe(pd.DataFrame(df.attrs['shards']), hide_index=True)
+
+# Admin tab: latency of each rerun stage across all sessions of this process
+if ADMIN_TAB:
+    with tabs[3]:
+        st.header("Rerun Stage Latency")
+        stage_summary = stage_timings.summary()
+        if len(stage_summary):
+            latency = stage_summary[['p50', 'p95', 'p99', 'max']] * 1000
+            st.dataframe(latency.add_suffix(' (ms)').join(stage_summary[['samples', 'count']]), width='stretch')
+            st.caption(f"Percentiles over the last {stage_timings.samples} runs of each stage; count is all-time. "
+                       f"Queries include aggregate cache hits; renders are drawn in the script thread.")
+        prometheus_text = stage_timings.prometheus()
+        st.download_button("Download (Prometheus text format)", prometheus_text,
+                           file_name="crime_dashboard_stages.prom", mime="text/plain")
+        with st.expander("Prometheus text"):
+            st.code(prometheus_text, language='text')
+    
+    # Admin tab: upsert a CSV of new and updated incidents into the in-memory data
+    if database is None:
+        with tabs[4]:
+            st.header("Incremental Updates")
+            st.write(f"Serving {total_rows} rows, {data_version} updates applied since the load. "
+                     f"Incidents are matched by ID; a known one is replaced when its Updated On is later.")
+            updates_file = st.file_uploader("CSV of new and updated incidents", type=['csv'])
+            if updates_file is not None and st.button("Apply updates"):
+                report = ingest_updates(updates_file)
+                st.success(f"{report['added']} added, {report['replaced']} replaced, {report['stale']} stale "
+                           f"of {report['received']} rows in {report['seconds']:.2f} s; now {report['rows']} rows. "
+                           f"Every session serves them from its next rerun.")
 
 # Footer
 st.markdown("---")
 st.markdown("**Data Source:** Chicago Police Department Crime Incidents Dataset")
+
+stage_timings.record('rerun', time.perf_counter() - rerun_start)
@@ -0,0 +1,132 @@
+"""Incremental updates against a fresh build: after random upserts, every
+patched structure must answer like one built from the updated rows.
+
+Run from this folder: python -m pytest test_crime_ingest.py
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from crime_aggregates import DESCRIBE_DATES, CrimeCube, DescribeSketch, TimeRollup, flag_rates, spatial_grid
+from crime_data import load_crime_data
+from crime_index import FilterIndex, SpatialIndex
+from crime_ingest import CrimeData, IdIndex, SegmentedFrame, apply_updates, read_updates
+
+DATASET = os.path.join(os.path.dirname(__file__), '..', 'exercise_files', 'dataset.csv')
+
+
+def random_batch(raw, known_ids, rng, batch):
+    """CSV of upserts: replaced rows with new values, new incidents, and stale versions."""
+    ids = rng.choice(known_ids, 70, replace=False)
+    picks = raw.iloc[rng.choice(len(raw), 60, replace=False)].copy()
+    picks['ID'] = ids[:60]
+    added = raw.iloc[rng.choice(len(raw), 20, replace=False)].copy()
+    added['ID'] = [str(10**9 + batch * 100 + i) for i in range(len(added))]
+    rows = pd.concat([picks, added], ignore_index=True)
+    types = list(raw['Primary Type'].unique()) + [f"NEW TYPE {batch}"]
+    rows['Primary Type'] = rng.choice(types, len(rows))
+    rows['Arrest'] = rng.choice(['True', 'False', ''], len(rows))
+    rows['Date'] = [f"{month:02d}/{day:02d}/{year} {hour:02d}:15:00 AM" for month, day, year, hour in
+                    zip(rng.integers(1, 13, len(rows)), rng.integers(1, 29, len(rows)),
+                        rng.integers(2001, 2031, len(rows)), rng.integers(1, 13, len(rows)))]
+    rows['Year'] = rows['Date'].str[6:10]
+    rows['District'] = rng.choice(['', *raw['District'].dropna().unique()], len(rows))
+    moved = rng.random(len(rows)) < 0.3
+    rows.loc[moved, 'Latitude'] = (41.7 + rng.random(moved.sum()) * 0.3).round(6).astype(str)
+    rows.loc[moved, 'Longitude'] = (-87.8 + rng.random(moved.sum()) * 0.3).round(6).astype(str)
+    unlocated = rng.random(len(rows)) < 0.1
+    rows.loc[unlocated, ['Latitude', 'Longitude']] = ''
+    rows['Updated On'] = f"01/01/{2040 + batch} 10:00:00 AM"
+    # Older versions of other incidents lose to their current ones
+    stale = rows.iloc[:10].copy()
+    stale['ID'] = ids[60:]
+    stale['Updated On'] = '01/01/2000 10:00:00 AM'
+    stale['Primary Type'] = 'STALE TYPE'
+    buffer = io.StringIO()
+    pd.concat([rows, stale]).sample(frac=1, random_state=batch).to_csv(buffer, index=False)
+    buffer.seek(0)
+    return read_updates(buffer)
+
+
+def build(df):
+    return CrimeData(SegmentedFrame(df), FilterIndex(df), SpatialIndex(df), CrimeCube(df),
+                     DescribeSketch(df), TimeRollup(df), IdIndex(df['ID'].to_numpy()))
+
+
+def sorted_cells(cube):
+    cells = cube.cells.astype({'Year': int}).astype(str)
+    return cells.sort_values(list(cells.columns)).reset_index(drop=True)
+
+
+def assert_same(patched, fresh, rng):
+    frame = fresh.df.base
+    n_rows = len(frame)
+    assert len(patched.df) == n_rows
+    ids = frame['ID'].to_numpy(dtype=np.int64)
+    assert np.array_equal(patched.ids.lookup(ids), np.arange(n_rows))
+    assert (patched.ids.lookup(np.array([-1, 10**12])) == -1).all()
+
+    rows = np.sort(rng.choice(n_rows, 200, replace=False))
+    assert patched.df.take(rows).equals(frame.take(rows).set_axis(rows))
+
+    area = fresh.spatial_index.radius(41.85, -87.65, 8)
+    assert np.array_equal(patched.spatial_index.radius(41.85, -87.65, 8), area)
+    assert np.array_equal(patched.spatial_index.bbox(41.75, 41.95, -87.75, -87.55),
+                          fresh.spatial_index.bbox(41.75, 41.95, -87.75, -87.55))
+    assert np.array_equal(patched.spatial_index.located(), fresh.spatial_index.located())
+    assert np.array_equal(patched.spatial_index.located(rows), fresh.spatial_index.located(rows))
+
+    columns = list(fresh.filter_index.values)
+    for _ in range(20):
+        filters = {}
+        for col in rng.choice(columns, rng.integers(1, 3), replace=False):
+            options = np.array(list(fresh.filter_index.values[col]), dtype=object)
+            filters[col] = list(rng.choice(options, min(len(options), rng.integers(1, 4)), replace=False))
+        for within in [None, area]:
+            selected = fresh.filter_index.select(filters, within)
+            assert np.array_equal(patched.filter_index.select(filters, within), selected), filters
+            assert patched.timeline.counts(selected, 'month').equals(fresh.timeline.counts(selected, 'month'))
+            assert patched.timeline.profile(selected, 'weekday').equals(fresh.timeline.profile(selected, 'weekday'))
+
+    for grain in ['hour', 'day', 'month', 'year']:
+        assert patched.timeline.counts(None, grain).equals(fresh.timeline.counts(None, grain))
+        assert patched.timeline.top_categories(None, grain).equals(fresh.timeline.top_categories(None, grain))
+
+    assert sorted_cells(patched.cube).equals(sorted_cells(fresh.cube))
+    for filters in [{}, {'Year': [2002, 2030]}, {'Primary Type': ['THEFT', 'NEW TYPE 0']}]:
+        patched_stats, _ = patched.describe_sketch.describe(filters)
+        fresh_stats, _ = fresh.describe_sketch.describe(filters)
+        assert patched_stats.loc['count'].equals(fresh_stats.loc['count'])
+        numbers = [col for col in fresh_stats.columns if col not in DESCRIBE_DATES]
+        np.testing.assert_allclose(patched_stats.loc[['mean', 'std'], numbers].to_numpy(dtype=float),
+                                   fresh_stats.loc[['mean', 'std'], numbers].to_numpy(dtype=float), rtol=1e-9)
+        for col in DESCRIBE_DATES:
+            # Means are shown to the second
+            difference = pd.Timestamp(patched_stats.loc['mean', col]) - pd.Timestamp(fresh_stats.loc['mean', col])
+            assert abs(difference) <= pd.Timedelta(seconds=1)
+
+    pieces = patched.df.pieces()
+    assert flag_rates(pieces, 'District').sort_index().equals(flag_rates(frame, 'District').sort_index())
+    cells = ['Latitude', 'Longitude']
+    assert (spatial_grid(pieces, 11).sort_values(cells).reset_index(drop=True)
+            .equals(spatial_grid(frame, 11).sort_values(cells).reset_index(drop=True)))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_patches_match_fresh_build(compact, seed):
+    rng = np.random.default_rng(seed)
+    raw = pd.read_csv(DATASET, dtype=str, keep_default_na=False)
+    data = build(load_crime_data(DATASET, snapshot=False, compact=compact))
+    loaded = data
+    for batch in range(4):
+        known_ids = data.df.take(None, ['ID'])['ID'].astype(str).to_numpy()
+        data, report = apply_updates(data, random_batch(raw, known_ids, rng, batch))
+        assert report['added'] == 20 and report['replaced'] == 60 and report['stale'] == 10
+        fresh = build(data.df.take())
+        assert_same(data, fresh, rng)
+    # The loaded version stays valid for reruns still reading it
+    assert_same(loaded, build(loaded.df.base), rng)